@@ -0,0 +1,92 @@
+""" shared fixtures for the tests of the tools that write sfnt data by hand """
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.sfnt import calcChecksum
+import io
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+
+# _unused comes before the composites, so dropping it renumbers the glyphs they refer to
+glyphOrder = ['.notdef', 'space', 'space.arab', '_unused', '_acute', '_dot', '_nested', 'a', 'aacute', 'adot', 'z']
+composites = {'aacute': ['a', '_acute'], 'adot': ['a', '_nested'], '_nested': ['_dot']}
+
+def buildFont(path, encodeUnused=False, extremeUnused=False):
+    """ write a small TrueType font with nested composites and an unreachable component.
+    With extremeUnused, the unreachable component's outline sets the font's bounding box """
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(glyphOrder)
+    cmap = {0x20: 'space', 0x61: 'a', 0xE1: 'aacute', 0x7A: 'z'}
+    if encodeUnused:
+        cmap[0xE000] = '_unused'
+    fb.setupCharacterMap(cmap)
+    glyphs = {}
+    for i, g in enumerate(glyphOrder):
+        pen = TTGlyphPen(glyphs)
+        if g in composites:
+            for j, c in enumerate(composites[g]):
+                pen.addComponent(c, (1, 0, 0, 1, 0, 100 * j))
+        elif g == '_unused' and extremeUnused:
+            pen.moveTo((-400, -300))
+            pen.lineTo((-400, 900))
+            pen.lineTo((1200, -300))
+            pen.closePath()
+        elif g not in ('space', 'space.arab'):
+            pen.moveTo((10 * i, 0))
+            pen.lineTo((10 * i, 500))
+            pen.lineTo((10 * i + 300, 0))
+            pen.closePath()
+        glyphs[g] = pen.glyph()
+    fb.setupGlyf(glyphs)
+    # distinct advances, so every glyph has its own hMetric
+    fb.setupHorizontalMetrics({g: (200 + 10 * i, 0) for i, g in enumerate(glyphOrder)})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': 'Zork', 'styleName': 'Regular'})
+    fb.setupOS2()
+    fb.setupPost()
+    fb.save(path)
+    return path
+
+@pytest.fixture
+def font(tmp_path):
+    return buildFont(str(tmp_path / 'Zork-Regular.ttf'))
+
+@pytest.fixture
+def extremeFont(tmp_path):
+    return buildFont(str(tmp_path / 'Zork-Bold.ttf'), extremeUnused=True)
+
+def tableXML(path, tag):
+    """ return the TTX dump of one table of a font file """
+    out = io.StringIO()
+    with TTFont(path) as f:
+        f.saveXML(out, tables=[tag])
+    return out.getvalue()
+
+def sameTables(path1, path2):
+    """ assert two fonts have the same tables with the same content, apart from head's
+    modification time and checksum adjustment """
+    with TTFont(path1) as f1, TTFont(path2) as f2:
+        assert sorted(f1.keys()) == sorted(f2.keys())
+        tags = f1.keys()
+    for tag in tags:
+        xml1, xml2 = tableXML(path1, tag), tableXML(path2, tag)
+        if tag == 'head':
+            xml1, xml2 = ([l for l in xml.splitlines() if 'modified' not in l and 'checkSumAdjustment' not in l] for xml in (xml1, xml2))
+        assert xml1 == xml2, f'{tag} differs'
+
+def checksumOK(path):
+    """ return True if the font file's checksums (including head.checkSumAdjustment) are consistent """
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    with TTFont(path) as f:
+        for tag, entry in f.reader.tables.items():
+            table = data[entry.offset:entry.offset + entry.length]
+            if tag == 'head':
+                table = table[:8] + b'\0\0\0\0' + table[12:]
+            if calcChecksum(table) != entry.checkSum:
+                return False
+    return calcChecksum(data) == 0xB1B0AFBA
@@ -0,0 +1,92 @@
+""" dropglyphs() and lowmemshake() write sfnt data themselves; check they agree with the subsetter """
+
+from fontTools.ttLib import TTFont
+import pytest
+import re
+import fontshaker
+from conftest import buildFont, sameTables, checksumOK
+
+componentRE = re.compile(r'^_')
+
+def unreachable(path):
+    """ the components fontshaker would remove """
+    with TTFont(path) as f:
+        order = f.getGlyphOrder()
+        components = set(filter(componentRE.search, order))
+        return components - fontshaker.reachable(fontshaker.componentGraph(f), set(order) - components)
+
+
+def test_dropglyphs_matches_subsetter(font, tmp_path):
+    toDelete = unreachable(font)
+    assert toDelete == {'_unused'}
+    dropped, subset = str(tmp_path / 'dropped.ttf'), str(tmp_path / 'subset.ttf')
+    assert fontshaker.dropglyphs(TTFont(font), toDelete, dropped) is None
+    with TTFont(font) as f:
+        fontshaker.subsetglyphs(f, set(f.getGlyphOrder()) - toDelete, subset)
+    sameTables(dropped, subset)
+    assert checksumOK(dropped)
+    with TTFont(dropped) as f:
+        # the composites' component references were renumbered
+        assert f['glyf']['adot'].getComponentNames(f['glyf']) == ['a', '_nested']
+
+def test_dropglyphs_recalculates_bounds(extremeFont, tmp_path):
+    with TTFont(extremeFont) as f:
+        head = f['head']
+        assert (head.xMin, head.yMin, head.xMax, head.yMax) == (-400, -300, 1200, 900)
+    dropped, subset = str(tmp_path / 'dropped.ttf'), str(tmp_path / 'subset.ttf')
+    assert fontshaker.dropglyphs(TTFont(extremeFont), {'_unused'}, dropped) is None
+    with TTFont(extremeFont) as f:
+        fontshaker.subsetglyphs(f, set(f.getGlyphOrder()) - {'_unused'}, subset)
+    sameTables(dropped, subset)
+    with TTFont(dropped) as f:
+        head = f['head']
+        assert (head.xMin, head.yMin, head.xMax, head.yMax) == (0, 0, 400, 600)
+
+def test_dropglyphs_declines_encoded_glyph(tmp_path):
+    font = buildFont(str(tmp_path / 'encoded.ttf'), encodeUnused=True)
+    out = tmp_path / 'out.ttf'
+    assert fontshaker.dropglyphs(TTFont(font), {'_unused'}, str(out)) == 'a glyph to be removed is encoded'
+    assert not out.exists()
+
+
+def test_lowmemshake_matches_dropglyphs(font, tmp_path):
+    lowmem, dropped = str(tmp_path / 'lowmem.ttf'), str(tmp_path / 'dropped.ttf')
+    assert fontshaker.lowmemshake(font, componentRE, lowmem) is None
+    assert fontshaker.dropglyphs(TTFont(font), unreachable(font), dropped) is None
+    sameTables(lowmem, dropped)
+    assert checksumOK(lowmem)
+
+def test_lowmemshake_recalculates_bounds(extremeFont, tmp_path):
+    lowmem, subset = str(tmp_path / 'lowmem.ttf'), str(tmp_path / 'subset.ttf')
+    assert fontshaker.lowmemshake(extremeFont, componentRE, lowmem) is None
+    with TTFont(extremeFont) as f:
+        fontshaker.subsetglyphs(f, set(f.getGlyphOrder()) - {'_unused'}, subset)
+    sameTables(lowmem, subset)
+    assert checksumOK(lowmem)
+
+def test_lowmemshake_writes_nothing_when_declining(tmp_path):
+    font = buildFont(str(tmp_path / 'encoded.ttf'), encodeUnused=True)
+    out = tmp_path / 'out.ttf'
+    graph = tmp_path / 'out.ttf.components.json'
+    assert fontshaker.lowmemshake(font, componentRE, str(out), str(graph)) is not None
+    assert not out.exists() and not graph.exists()
+
+@pytest.mark.parametrize('lowmem', [False, True])
+def test_family_checks_each_member(font, extremeFont, tmp_path, lowmem):
+    # same glyph order as the other members, but adot uses _dot directly, leaving _nested unused
+    other = str(tmp_path / 'Zork-Italic.ttf')
+    with TTFont(font) as f:
+        f['glyf']['adot'].components[1].glyphName = '_dot'
+        f.save(other)
+    family = fontshaker.FamilyAnalysis(font, componentRE)
+    assert fontshaker.shakefile(font, componentRE, str(tmp_path / 'regular.ttf'), lowmem=lowmem, family=family)
+    assert family.toDelete == ['_unused']
+
+    bold, alone = str(tmp_path / 'bold.ttf'), str(tmp_path / 'alone.ttf')
+    assert fontshaker.shakefile(extremeFont, componentRE, bold, lowmem=lowmem, family=family)
+    assert fontshaker.shakefile(extremeFont, componentRE, alone, lowmem=lowmem)
+    sameTables(bold, alone)
+
+    italic = tmp_path / 'italic.ttf'
+    assert not fontshaker.shakefile(other, componentRE, str(italic), lowmem=lowmem, family=family)
+    assert not italic.exists()
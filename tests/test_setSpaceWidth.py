@@ -0,0 +1,27 @@
+""" RawVariantWriter patches hmtx, name and head in place; check it agrees with writevariant """
+
+from fontTools.ttLib import TTFont
+import pytest
+import setSpaceWidth
+from conftest import sameTables, checksumOK
+
+@pytest.mark.parametrize('spacewidth, arabwidth', [(300, None), (300, 210)])
+def test_raw_variant_matches_writevariant(font, tmp_path, spacewidth, arabwidth):
+    suffix = setSpaceWidth.suffixfor(spacewidth, arabwidth)
+    raw, slow = str(tmp_path / 'raw.ttf'), str(tmp_path / 'slow.ttf')
+    widths = {'space': spacewidth}
+    if arabwidth is not None:
+        widths['space.arab'] = arabwidth
+
+    with TTFont(font) as f:
+        assert setSpaceWidth.RawVariantWriter.usable(f, ('space', 'space.arab'))
+        setSpaceWidth.RawVariantWriter(f).write(raw, widths, suffix)
+    with TTFont(font) as f:
+        setSpaceWidth.writevariant(f, slow, spacewidth, arabwidth)
+
+    sameTables(raw, slow)
+    assert checksumOK(raw)
+    with TTFont(raw) as f:
+        for glyph, width in widths.items():
+            assert f['hmtx'][glyph][0] == width
+        assert f['name'].getDebugName(1) == f'Zork{suffix}'
@@ -0,0 +1,103 @@
+""" traceFea() finds candidate rules through LookupIndex; check it reports what the original linear scan did """
+
+from fontTools.feaLib import ast
+import itertools
+import os
+import tracefea
+
+fea = '''
+@L = [a b c];
+@R = [b c d];
+lookup single {
+  pos a 10;
+  pos @L 20;
+  pos [c d] 30;
+} single;
+lookup mainkern {
+  pos a b -10;
+  pos @L @R -20;
+  pos [a d] @R -30;
+  pos @L b -40;
+  pos a' lookup single b c;
+  pos b' lookup single @R;
+  pos c d -50;
+  pos @R @L -60;
+} mainkern;
+'''
+
+def glyphMatch(glyphName, glyphObject):
+    if isinstance(glyphObject, ast.GlyphName):
+        return glyphName == glyphObject.glyph
+    elif isinstance(glyphObject, ast.GlyphClassName):
+        return glyphName in glyphObject.glyphclass.glyphs.glyphs
+    return glyphName in glyphObject.glyphs
+
+def linearTrace(lkup, glyphs, offset=0):
+    """ the linear scan over a LookupBlock's statements that LookupIndex replaced """
+    res = []
+    for s in lkup.statements:
+        if isinstance(s, ast.SinglePosStatement):
+            for pos in s.pos:
+                if glyphMatch(glyphs[offset], pos[0]):
+                    masked = '# (MASKED)' if len(res) > 0 else ''
+                    res.append(f"{tracefea.loc(s)} Lookup {lkup.name} SinglePos {glyphs[offset]} --> {pos[1].asFea()}  {masked}")
+        elif isinstance(s, ast.PairPosStatement):
+            if offset + 1 < len(glyphs) and glyphMatch(glyphs[offset], s.glyphs1) and glyphMatch(glyphs[offset + 1], s.glyphs2):
+                masked = '# (MASKED)' if len(res) > 0 else ''
+                res.append(f"{tracefea.loc(s)} Lookup {lkup.name} PairPos {glyphs[offset]},{glyphs[offset + 1]} --> {s.asFea()}  {masked}")
+        elif isinstance(s, ast.ChainContextPosStatement):
+            context = s.glyphs + s.suffix
+            if offset + len(context) > len(glyphs) or not all(glyphMatch(glyphs[offset + i], g) for i, g in enumerate(context)):
+                continue
+            masked = '# (MASKED)' if len(res) > 0 else ''
+            res.append(f"{tracefea.loc(s)} Lookup {lkup.name} Context match --> {s.asFea()}  {masked}")
+            if len(res) == 1:
+                for i, lkupList in enumerate(s.lookups):
+                    for l in lkupList or ():
+                        res.extend(linearTrace(l, glyphs, offset + i))
+    return res
+
+
+def test_traceFea_matches_linear_scan(tmp_path):
+    feapath = tmp_path / 'test.fea'
+    feapath.write_text(fea, encoding='utf-8')
+    lookup = tracefea.findLookup(tracefea.parseFea(str(feapath)), 'mainkern')
+    index = tracefea.compileLookup(lookup)
+    masked = 0
+    # the first query of a LookupIndex scans its rules and later ones use the index; both must agree with the linear scan
+    for n in (1, 2, 3):
+        for glyphs in itertools.product('abcde', repeat=n):
+            expected = linearTrace(lookup, glyphs)
+            assert tracefea.traceFea(tracefea.LookupIndex(lookup, {}), glyphs) == expected, glyphs
+            assert tracefea.traceFea(index, glyphs) == expected, glyphs
+            masked += sum('MASKED' in line for line in expected)
+    assert masked > 0
+
+
+kerndata = '''\
+[a] [b] {-10}
+[b] [c] {-20}
+[a] [b] {-30}
+[c] [d]
+'''
+
+def test_rawKernIndex_stores_index_in_indexdir(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    kernfile = data / 'kern.txt'
+    kernfile.write_text(kerndata, encoding='utf-8')
+    indexdir = tmp_path / 'index'
+    with tracefea.RawKernIndex(str(kernfile), str(indexdir)) as index:
+        assert [(lineno, kerns) for lineno, line, kerns in index.find(['a', 'b'])] == [(0, ['-10']), (2, ['-30'])]
+    assert index.fd is None
+    assert sorted(p.name for p in data.iterdir()) == ['kern.txt']
+    assert len(list(indexdir.glob('*.idx'))) == 1
+    # the stored index is reused
+    with tracefea.RawKernIndex(str(kernfile), str(indexdir)) as index:
+        assert isinstance(index.buf, tracefea.mmap.mmap)
+        assert [lineno for lineno, line, kerns in index.find(['b', 'c'])] == [1]
+
+def test_rawKernIndex_stores_nothing_for_devnull(tmp_path):
+    with tracefea.RawKernIndex(os.devnull, str(tmp_path)) as index:
+        assert list(index.find(['a', 'b'])) == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+""" benchmark the tools on synthetic fonts and feature files
+
+Builds (once, into the fixtures folder) fonts of the requested glyph counts,
+with nested composites made of _-prefixed components (some of them unused, so
+there is something to shake), and kerning fea files with the requested numbers
+of pair rules. Each benchmark then runs a tool as a subprocess several times,
+and the wall times, together with the tool's own phase timings from one more
+run with --stats-json, are written as JSON.
+
+Fixtures are generated from a fixed seed, so runs on different commits see
+identical inputs and can be compared with --compare.
+"""
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.woff2 import WOFFFlavorData
+import fontTools
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+toolsdir = os.path.dirname(os.path.abspath(__file__))
+
+def glyphNames(numGlyphs, depth):
+    """ return (bases, components) for a synthetic font of numGlyphs glyphs in all;
+    components are in depth layers, a quarter of the glyphs in all """
+    numComponents = max(numGlyphs // 4, depth)
+    numBases = numGlyphs - numComponents - 3     # .notdef, space, space.arab
+    bases = [f'g{i:05d}' for i in range(numBases)]
+    layers = [[f'_c{layer}.{i:05d}' for i in range(layer, numComponents, depth)] for layer in range(depth)]
+    return bases, layers
+
+def rectangle(pen, x, y, w, h):
+    pen.moveTo((x, y))
+    pen.lineTo((x, y + h))
+    pen.lineTo((x + w, y + h))
+    pen.lineTo((x + w, y))
+    pen.closePath()
+
+def buildFont(path, numGlyphs, depth=4, seed=1):
+    """ build a TrueType font of numGlyphs glyphs with composites nested depth deep
+
+    Components in layer 0 are simple; each component in a higher layer uses one
+    or two from the layer below. Most base glyphs use one to three top-layer
+    components, but only about 80% of the top layer is used by any of them.
+    """
+    rng = random.Random(seed)
+    bases, layers = glyphNames(numGlyphs, depth)
+    glyphs = {}
+    pen = TTGlyphPen(glyphs)
+    for name in ('.notdef', 'space', 'space.arab'):
+        if name == '.notdef':
+            rectangle(pen, 50, 0, 400, 700)
+        glyphs[name] = pen.glyph()
+        pen = TTGlyphPen(glyphs)
+
+    for name in layers[0]:
+        rectangle(pen, rng.randrange(0, 300), rng.randrange(-200, 500), rng.randrange(20, 200), rng.randrange(20, 200))
+        glyphs[name] = pen.glyph()
+        pen = TTGlyphPen(glyphs)
+    for below, layer in zip(layers, layers[1:]):
+        for name in layer:
+            for component in rng.sample(below, min(len(below), rng.randint(1, 2))):
+                pen.addComponent(component, (1, 0, 0, 1, rng.randrange(-50, 50), rng.randrange(-50, 50)))
+            glyphs[name] = pen.glyph()
+            pen = TTGlyphPen(glyphs)
+
+    used = layers[-1][:max(1, len(layers[-1]) * 4 // 5)]
+    for name in bases:
+        if rng.random() < 0.6:
+            for component in rng.sample(used, min(len(used), rng.randint(1, 3))):
+                pen.addComponent(component, (1, 0, 0, 1, rng.randrange(0, 300), 0))
+        else:
+            rectangle(pen, 50, 0, rng.randrange(100, 500), rng.randrange(300, 700))
+        glyphs[name] = pen.glyph()
+        pen = TTGlyphPen(glyphs)
+
+    glyphOrder = ['.notdef', 'space', 'space.arab'] + bases + [g for layer in layers for g in layer]
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(glyphOrder)
+    cmap = {0x20: 'space', 0x0600: 'space.arab'}
+    cmap.update({0xF0000 + i: name for i, name in enumerate(bases)})
+    fb.setupCharacterMap(cmap)
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({name: (600 if name in cmap.values() or name == '.notdef' else 0, 0) for name in glyphOrder})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': 'Bench', 'styleName': 'Regular'})
+    fb.setupOS2(sTypoAscender=800, sTypoDescender=-200, usWinAscent=800, usWinDescent=200)
+    fb.setupPost()
+    fb.save(path)
+    return glyphOrder
+
+def writeKernFea(path, glyphs, numPairs, seed=1):
+    """ write a fea file with a kern lookup of numPairs pair rules among glyphs
+
+    About one rule in ten is a class pair (using one of 200 glyph classes); the
+    rest are glyph pairs. A single positioning lookup and a contextual one are
+    included so that feature traces have more than one lookup to go through.
+    """
+    rng = random.Random(seed)
+    classes = [rng.sample(glyphs, min(len(glyphs), rng.randint(5, 50))) for i in range(200)]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, members in enumerate(classes):
+            f.write(f"@k{i} = [{' '.join(members)}];\n")
+        f.write('lookup single {\n')
+        for g in rng.sample(glyphs, min(len(glyphs), 100)):
+            f.write(f'  pos {g} {rng.randrange(-50, 50)};\n')
+        f.write('} single;\n')
+        f.write('lookup mainkern {\n')
+        for i in range(numPairs):
+            if rng.random() < 0.1:
+                f.write(f'  pos @k{rng.randrange(200)} @k{rng.randrange(200)} {rng.randrange(-100, 0)};\n')
+            else:
+                f.write(f'  pos {rng.choice(glyphs)} {rng.choice(glyphs)} {rng.randrange(-100, 100)};\n')
+        f.write('} mainkern;\n')
+        f.write('lookup ctx {\n')
+        for i in range(100):
+            f.write(f"  pos {rng.choice(glyphs)} {rng.choice(glyphs)}' lookup single {rng.choice(glyphs)};\n")
+        f.write('} ctx;\n')
+        f.write('feature kern {\n  lookup single;\n  lookup mainkern;\n  lookup ctx;\n} kern;\n')
+
+def writeWoff(woffpath, ttfpath):
+    """ save a WOFF copy of a font, with extended metadata holding a unique ID """
+    font = TTFont(ttfpath)
+    font.flavor = 'woff'
+    font.flavorData = WOFFFlavorData()
+    font.flavorData.metaData = b'<?xml version="1.0" encoding="UTF-8"?>\n<metadata version="1.0"><uniqueid id="org.example.bench"/></metadata>'
+    font.save(woffpath)
+
+
+class Fixtures(object):
+    """ the synthetic fonts and fea files, built into folder unless already there """
+
+    def __init__(self, folder, sizes, pairs, depth, seed):
+        self.folder = folder
+        self.info = {}
+        os.makedirs(folder, exist_ok=True)
+        self.fonts = {size: self._build(f'bench-{size}-d{depth}-s{seed}.ttf', buildFont, size, depth, seed) for size in sizes}
+        # The fea files use the glyph names of the smallest font, so traces can hit real pairs
+        glyphs = glyphNames(min(sizes), depth)[0]
+        self.feas = {n: self._build(f'kern-{n}-{min(sizes)}-s{seed}.fea', lambda path: writeKernFea(path, glyphs, n, seed)) for n in pairs}
+        self.glyphs = glyphs
+        self.woff = self._build(f'bench-{min(sizes)}-d{depth}-s{seed}.woff', writeWoff, self.fonts[min(sizes)])
+
+    def _build(self, filename, build, *args):
+        path = os.path.join(self.folder, filename)
+        if not os.path.exists(path):
+            print(f'building {path}', file=sys.stderr)
+            start = time.perf_counter()
+            build(f'{path}.tmp', *args)
+            os.replace(f'{path}.tmp', path)
+            self.info[filename] = {'buildSeconds': time.perf_counter() - start}
+        self.info.setdefault(filename, {})['bytes'] = os.path.getsize(path)
+        return path
+
+
+def runTool(tool, args, repeat, cwd, statsfile):
+    """ run a tool repeatedly, returning (wall times, stats)
+
+    The timed runs are plain; the phase stats come from one more run with
+    --stats-json, as tracing memory allocations slows the tool down.
+    """
+    argv = [sys.executable, os.path.join(toolsdir, tool)] + [str(a) for a in args]
+    times = []
+    for i in range(repeat + 1):
+        run = argv if i < repeat else argv + ['--stats-json', statsfile]
+        start = time.perf_counter()
+        result = subprocess.run(run, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if i < repeat:
+            times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f'{tool} failed ({result.returncode}): {result.stderr.strip()}')
+    with open(statsfile, encoding='utf-8') as f:
+        return times, json.load(f)
+
+def benchmarks(fixtures, workdir):
+    """ yield (name, tool, args, cwd) for each benchmark """
+    outdir = os.path.join(workdir, 'out')
+    os.makedirs(outdir, exist_ok=True)
+    cachedir = os.path.join(workdir, 'tracefea-cache')
+    glyphs = fixtures.glyphs
+    pairsample = ','.join(random.Random(2).sample(glyphs, min(len(glyphs), 30)))
+    batchfile = os.path.join(workdir, 'batch.txt')
+    with open(batchfile, 'w', encoding='utf-8') as f:
+        rng = random.Random(3)
+        for i in range(10000):
+            f.write(f'{rng.choice(glyphs)},{rng.choice(glyphs)}\n')
+    proof = ','.join(random.Random(4).choices(glyphs, k=200))
+
+    for size, font in fixtures.fonts.items():
+        yield f'fontshaker/{size}', 'fontshaker.py', ['-o', os.path.join(outdir, f'shaken-{size}.ttf'), font], workdir
+    for n, fea in fixtures.feas.items():
+        yield f'tracefea-single-nocache/{n}', 'tracefea.py', ['--nocache', fea, f'{glyphs[0]},{glyphs[1]}'], workdir
+        yield f'tracefea-single-cached/{n}', 'tracefea.py', ['--cachedir', cachedir, fea, f'{glyphs[0]},{glyphs[1]}'], workdir
+        yield f'tracefea-allpairs/{n}', 'tracefea.py', ['--cachedir', cachedir, '--allpairs', fea, pairsample], workdir
+        yield f'tracefea-batch/{n}', 'tracefea.py', ['--cachedir', cachedir, '-b', batchfile, fea], workdir
+        yield f'tracefea-feature/{n}', 'tracefea.py', ['--cachedir', cachedir, '-F', 'kern', fea, proof], workdir
+    for size, font in fixtures.fonts.items():
+        # setSpaceWidth writes next to its input, so work on a copy
+        copy = os.path.join(outdir, f'space-{size}.ttf')
+        shutil.copyfile(font, copy)
+        yield f'setSpaceWidth/{size}', 'setSpaceWidth.py', ['200..400:50,210', copy], workdir
+    allfonts = list(fixtures.fonts.values())
+    yield 'showLineMetrics', 'showLineMetrics.py', ['--nocache'] + allfonts, outdir
+    yield 'showfsSelection', 'showfsSelection.py', ['--nocache'] + allfonts, outdir
+    yield 'showGlyphMetrics', 'showGlyphMetrics.py', ['-o', os.path.join(outdir, 'glyphMetrics.csv')] + allfonts, outdir
+    yield 'showWoffUniqueID', 'showWoffUniqueID.py', [fixtures.woff], outdir
+
+def gitCommit():
+    """ return the current commit of the repo holding the tools, if there is one """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=toolsdir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """ print the change in median time of each benchmark from a baseline results file """
+    with open(baseline, encoding='utf-8') as f:
+        before = {r['name']: r for r in json.load(f)['results']}
+    print(f"{'benchmark':40} {'before':>10} {'after':>10} {'change':>8}")
+    for r in results:
+        if r['name'] not in before or 'median' not in before[r['name']] or 'median' not in r:
+            continue
+        old, new = before[r['name']]['median'], r['median']
+        print(f"{r['name']:40} {old:10.3f} {new:10.3f} {(new - old) / old * 100:+7.1f}%")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--outfile', help='results file (default: %(default)s)', default='benchmark.json')
+    parser.add_argument('-s', '--sizes', help='comma-separated glyph counts of the fonts to build, up to 65000 (default: %(default)s)', default='500,5000,65000')
+    parser.add_argument('-p', '--pairs', help='comma-separated numbers of kern pair rules in the fea files to build (default: %(default)s)', default='10000,100000,500000')
+    parser.add_argument('-d', '--depth', help='depth of composite nesting (default: %(default)s)', type=int, default=4)
+    parser.add_argument('--seed', help='random seed for the fixtures (default: %(default)s)', type=int, default=1)
+    parser.add_argument('-r', '--repeat', help='times to run each benchmark (default: %(default)s)', type=int, default=3)
+    parser.add_argument('-k', '--only', help='run only benchmarks whose names contain this string', metavar='SUBSTRING')
+    parser.add_argument('--fixtures', help='folder for the generated fonts and fea files, reused between runs (default: %(default)s)', default='benchmark-fixtures')
+    parser.add_argument('--compare', metavar='BASELINE', help='print the changes from an earlier results file')
+    args = parser.parse_args(args)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    pairs = [int(n) for n in args.pairs.split(',')]
+    if max(sizes) > 65000 or min(sizes) < 100:
+        parser.error('font sizes must be between 100 and 65000 glyphs')
+
+    # The tools run in the work and output folders, so the fixture paths given them must be absolute
+    args.fixtures = os.path.abspath(args.fixtures)
+    fixtures = Fixtures(args.fixtures, sizes, pairs, args.depth, args.seed)
+    workdir = os.path.join(args.fixtures, 'work')
+    os.makedirs(workdir, exist_ok=True)
+    statsfile = os.path.join(workdir, 'stats.json')
+
+    results = []
+    for name, tool, toolargs, cwd in benchmarks(fixtures, workdir):
+        if args.only and args.only not in name:
+            continue
+        print(f'running {name}', file=sys.stderr)
+        result = {'name': name, 'tool': tool, 'args': [os.path.basename(str(a)) for a in toolargs]}
+        try:
+            times, stats = runTool(tool, toolargs, args.repeat, cwd, statsfile)
+        except RuntimeError as e:
+            print(f'{name}: {e}', file=sys.stderr)
+            result['error'] = str(e)
+        else:
+            result.update({'times': times, 'min': min(times), 'median': statistics.median(times),
+                           'phases': stats['phases'], 'tables': stats['tables'], 'peakMemory': stats['peakMemory']})
+        results.append(result)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'fontTools': fontTools.version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {'sizes': sizes, 'pairs': pairs, 'depth': args.depth, 'seed': args.seed, 'repeat': args.repeat},
+        'fixtures': fixtures.info,
+        'results': results,
+    }
+    with open(args.outfile, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare:
+        compare(results, args.compare)
+    return 1 if any('error' in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
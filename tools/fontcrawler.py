@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+""" find font files and read them concurrently for the show* reporting tools
+
+On network-mounted archives most of a tool's time goes in waiting for reads.
+crawl() runs each tool's extractor on a bounded pool of threads, so reads of
+upcoming files overlap with the parsing of earlier ones, while results still
+come back in input order. The extractors are given paths, and read only the
+parts of each file they need.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from glob import glob
+import os
+
+# Font collections (.ttc) aren't included: the tools' extractors read single fonts
+fontExtensions = ('.ttf', '.otf', '.woff', '.woff2')
+
+
+def findfonts(args, extensions=fontExtensions):
+    """ yield font file paths named by args, which may be file names, wildcards or folders.
+    Folders are searched recursively for files with the given extensions (a tuple of
+    lowercase extensions; fontExtensions by default). """
+    for arg in args:
+        for path in glob(arg):
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(extensions):
+                        yield os.path.join(dirpath, filename)
+
+def crawl(paths, extract, jobs=8):
+    """ run extract(path) for each of paths on up to jobs threads
+
+    Yields (path, result, error) in the order of paths, where error is the
+    exception raised by extract (and result None) if it failed. At most
+    2 * jobs files are in progress at any time.
+    """
+    if jobs <= 1:
+        for path in paths:
+            try:
+                yield path, extract(path), None
+            except Exception as e:
+                yield path, None, e
+        return
+
+    def run(path):
+        try:
+            return extract(path), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(run, path)))
+            if len(pending) >= 2 * jobs:
+                path, future = pending.popleft()
+                yield (path,) + future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield (path,) + future.result()
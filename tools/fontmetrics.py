@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+""" extract header fields from fonts one at a time, reading only the tables needed
+
+The show* reporting tools use this so that only the sfnt table directory and
+the requested tables are ever read, and only one font is open at any time.
+"""
+
+from fontTools.ttLib import TTFont
+from io import BytesIO
+import contextlib
+import json
+import os
+import instrument
+
+
+def _open(fontfile):
+    """ open a font lazily from a path or from the file's contents.
+    An already open TTFont (e.g. from a fontpool.FontPool) is used as is, and not closed. """
+    if isinstance(fontfile, TTFont):
+        return contextlib.nullcontext(fontfile)
+    if isinstance(fontfile, (bytes, bytearray, memoryview)):
+        fontfile = BytesIO(fontfile)
+    return TTFont(fontfile, lazy=True)
+
+def readfields(fontfile, tables):
+    """ return the requested fields from one font (a path, the file's contents or a TTFont)
+
+    tables is a sequence of (tablename, fieldnames) pairs. The result is a dict
+    mapping each tablename present in the font to a dict of fieldname: value;
+    fields not present in the font's version of the table have value None.
+    Tables missing from the font are missing from the result.
+    """
+    res = {}
+    with instrument.phase('read fields'), _open(fontfile) as f:
+        for tablename, fieldnames in tables:
+            if tablename not in f:
+                continue
+            table = f[tablename]
+            res[tablename] = {fieldname: getattr(table, fieldname, None) for fieldname in fieldnames}
+    return res
+
+
+class FieldCache(object):
+    """ on-disk cache of readfields() results
+
+    Entries are keyed by font path and validated against the file's size and
+    modification time, so unchanged fonts are never reopened. The cache is a
+    JSON file with a separate section for each set of requested fields. Call
+    save() when done.
+    """
+
+    def __init__(self, cachefile, tables, rebuild=False):
+        self.cachefile = cachefile
+        self.tables = tuple((tablename, tuple(fieldnames)) for tablename, fieldnames in tables)
+        self.sections = {}
+        if not rebuild:
+            try:
+                with instrument.phase('load cache'), open(cachefile, encoding='utf-8') as f:
+                    self.sections = json.load(f)
+            except (OSError, ValueError):
+                pass    # no usable cache; start afresh
+        self.entries = self.sections.setdefault(json.dumps(self.tables), {})
+
+    def readfields(self, fontfile, read=None):
+        """ like readfields(), but served from the cache if the font file hasn't changed.
+        If supplied, read(fontfile) is used to get the file's contents (or a TTFont, e.g.
+        FontPool.get) on a cache miss. """
+        st = os.stat(fontfile)
+        path = os.path.abspath(fontfile)
+        entry = self.entries.get(path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return entry['fields']
+        fields = readfields(fontfile if read is None else read(fontfile), self.tables)
+        self.entries[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'fields': fields}
+        return fields
+
+    def save(self):
+        """ write the cache, dropping entries for fonts that no longer exist """
+        for entries in self.sections.values():
+            for path in [path for path in entries if not os.path.exists(path)]:
+                del entries[path]
+        tmpfile = f'{self.cachefile}.{os.getpid()}.tmp'
+        with instrument.phase('save cache'), open(tmpfile, 'w', encoding='utf-8') as f:
+            json.dump(self.sections, f)
+        os.replace(tmpfile, self.cachefile)
+
+
+glyphMetricNames = ('advance', 'lsb', 'xMin', 'yMin', 'xMax', 'yMax')
+
+def readglyphmetrics(fontfile):
+    """ return (glyphOrder, metrics) for one font (a path, the file's contents or a TTFont)
+
+    metrics is a NumPy float64 array with one row per glyph and columns as
+    named in glyphMetricNames. Values come straight from the raw hmtx, loca and
+    glyf data; the bounding box is NaN for empty glyphs and for fonts with no
+    glyf table.
+    """
+    import numpy as np
+
+    with instrument.phase('read glyph metrics'), _open(fontfile) as f:
+        glyphOrder = f.getGlyphOrder()
+        numGlyphs = len(glyphOrder)
+        metrics = np.full((numGlyphs, len(glyphMetricNames)), np.nan)
+
+        # hmtx: numberOfHMetrics (advance, lsb) pairs, then lsbs for the remaining glyphs
+        numberOfHMetrics = f['hhea'].numberOfHMetrics
+        hmtx = np.frombuffer(f.reader['hmtx'], dtype='>i2')
+        longMetrics = hmtx[:2 * numberOfHMetrics].reshape(-1, 2)
+        metrics[:numberOfHMetrics, 0] = longMetrics[:, 0].view('>u2')
+        metrics[numberOfHMetrics:, 0] = metrics[numberOfHMetrics - 1, 0]
+        metrics[:numberOfHMetrics, 1] = longMetrics[:, 1]
+        metrics[numberOfHMetrics:, 1] = hmtx[2 * numberOfHMetrics:2 * numberOfHMetrics + numGlyphs - numberOfHMetrics]
+
+        # glyf: the bounding box is in each non-empty glyph's header
+        if 'glyf' in f and 'loca' in f:
+            if f['head'].indexToLocFormat:
+                loca = np.frombuffer(f.reader['loca'], dtype='>u4')[:numGlyphs + 1].astype(np.int64)
+            else:
+                loca = np.frombuffer(f.reader['loca'], dtype='>u2')[:numGlyphs + 1].astype(np.int64) * 2
+            glyf = np.frombuffer(f.reader['glyf'], dtype=np.uint8)
+            present = np.nonzero(loca[1:] > loca[:-1])[0]
+            header = glyf[np.add.outer(loca[present] + 2, np.arange(8))]
+            metrics[present, 2:] = header.reshape(-1).view('>i2').reshape(-1, 4)
+    return glyphOrder, metrics
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+""" an in-process pool of open fonts, for scripts that run several tools over the same fonts
+
+Fonts are keyed by path and validated against the file's modification time and
+size, so a font rewritten by an earlier step is reloaded. Each file is read
+once; get() hands out a lazily loaded TTFont shared by all callers, so each
+table is decompiled at most once and then shared read-only, and copy() a
+private TTFont made from the same bytes for tools that modify the font. The
+least recently used fonts are dropped from the pool when it holds more than
+maxfonts fonts or maxbytes of font data.
+
+A build script can then chain the tools with each font parsed once:
+
+    from fontpool import FontPool
+    from fontshaker import shakefile
+    from setSpaceWidth import makevariants, parsespec
+    from fontmetrics import readfields
+    import re
+
+    pool = FontPool()
+    shakefile('Zork-Regular.ttf', re.compile(r'^_'), 'out/Zork-Regular.ttf', pool=pool)
+    makevariants('out/Zork-Regular.ttf', parsespec('300,210'), pool=pool)
+    fields = readfields(pool.get('out/Zork-Regular-300-210.ttf'), (('hhea', ('ascent', 'descent')),))
+
+Fonts from get() must not be modified, and, like any TTFont, should not have
+tables loaded from more than one thread at a time.
+"""
+
+from fontTools.ttLib import TTFont
+from collections import OrderedDict
+from io import BytesIO
+import os
+import threading
+import instrument
+
+
+class FontPool(object):
+    """ LRU pool of lazily loaded fonts, keyed by path and validated by mtime and size """
+
+    def __init__(self, maxfonts=32, maxbytes=512 * 1024 * 1024):
+        self.maxfonts = maxfonts
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()    # abspath -> (mtime_ns, size, data, font); most recently used last
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _entry(self, path):
+        """ return the pool entry for path, (re)reading the file if it's new or has changed """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._drop(path)
+            self.misses += 1
+
+        with instrument.phase('read file'), open(path, 'rb') as f:
+            data = f.read()
+        font = TTFont(BytesIO(data), lazy=True)
+        entry = (st.st_mtime_ns, st.st_size, data, font)
+        with self.lock:
+            if path in self.entries:
+                self._drop(path)
+            self.entries[path] = entry
+            self.nbytes += len(data)
+            while len(self.entries) > 1 and (len(self.entries) > self.maxfonts or self.nbytes > self.maxbytes):
+                self._drop(next(iter(self.entries)))
+        return entry
+
+    def _drop(self, path):
+        # Fonts handed out keep working after being dropped; the pool just forgets them
+        mtime, size, data, font = self.entries.pop(path)
+        self.nbytes -= len(data)
+
+    def get(self, path):
+        """ return the shared, lazily loaded TTFont for path; it must not be modified """
+        return self._entry(path)[3]
+
+    def copy(self, path, **kwargs):
+        """ return a private TTFont for path, which the caller may modify and close.
+        It is made from the pooled file contents, so the file isn't read again. """
+        return TTFont(BytesIO(self._entry(path)[2]), **kwargs)
+
+    def data(self, path):
+        """ return the contents of the font file at path """
+        return self._entry(path)[2]
+
+    def forget(self, path):
+        """ drop path from the pool, e.g. after writing a new version of it """
+        with self.lock:
+            if os.path.abspath(path) in self.entries:
+                self._drop(os.path.abspath(path))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
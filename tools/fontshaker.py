@@ -16,36 +16,171 @@ import sys
 import re
 from pathlib import Path
 import argparse  
-from fontTools.ttLib import TTFont
+from fontTools.ttLib import TTFont, newTable
+from fontTools.ttLib.tables.otBase import BaseTable
 from fontTools import subset
 from glob import glob
 import logging
+from concurrent.futures import ProcessPoolExecutor
+import os
+import json
+import mmap
+import struct
+from array import array
+from fontTools.ttLib.sfnt import calcChecksum
+from fontTools.ttLib import getSearchRange
+import instrument
 
-def ftshake(f, componentNameRE, outpath):
-    logger = logging.getLogger('glyphShaker')
-    
-    gnames = set(f.getGlyphSet().keys())
-    allComponents = set(filter(componentNameRE.search, gnames))
-    neededComponents = set()
+def componentGraph(f):
+    """ return dict mapping each composite glyph's name to the names of its components.
+    Component references are read from the raw glyf data, so glyphs aren't fully decompiled. """
     gtable = f['glyf']
+    graph = {}
+    for gname, g in gtable.glyphs.items():
+        components = g.getComponentNames(gtable)
+        if components:
+            graph[gname] = components
+    return graph
 
-    # In case nested composites haven't yet been flattened, use
-    # recursion to make sure all components that are actually 
-    # needed are identified
-    def markneeded(gname):
-        if gname in allComponents:
-            neededComponents.add(gname)
-        g = gtable[gname]
-        if g.isComposite():
-            for c in g.components:
-                markneeded(c.glyphName)
-
-    for gname in gnames - allComponents:
-        markneeded(gname)
-
-    toDelete = allComponents-neededComponents
-    toKeep = gnames - toDelete
+def reachable(graph, roots):
+    """ return the set of glyphs used, directly or through nested composites, by the roots """
+    seen = set()
+    stack = list(roots)
+    while stack:
+        for c in graph.get(stack.pop(), ()):
+            if c not in seen:
+                seen.add(c)
+                stack.append(c)
+    return seen
+
+def keptBy(graph, roots, components):
+    """ return dict mapping each of components to the glyphs that use it directly and
+    the root glyphs that (possibly through nested composites) keep it alive """
+    users = {}
+    for gname, comps in graph.items():
+        for c in comps:
+            users.setdefault(c, set()).add(gname)
+    res = {}
+    for component in components:
+        seen = {component}
+        stack = [component]
+        keepers = set()
+        while stack:
+            for u in users.get(stack.pop(), ()):
+                if u not in seen:
+                    seen.add(u)
+                    stack.append(u)
+                    if u in roots:
+                        keepers.add(u)
+        res[component] = {'usedBy': sorted(users.get(component, ())), 'roots': sorted(keepers)}
+    return res
+
+# Tables dropglyphs() rewrites itself. fontTools refers to glyphs by name in all of
+# them, so recompiling them with the new glyph order renumbers them correctly.
+_rewrittenTables = {'glyf', 'loca', 'hmtx', 'hhea', 'vmtx', 'vhea', 'maxp', 'post', 'cmap', 'head', 'DSIG'}
+# Tables that don't refer to glyph IDs (or glyph count) and so are copied byte-for-byte
+_glyphFreeTables = {'OS/2', 'name', 'gasp', 'cvt ', 'fpgm', 'prep', 'VDMX', 'cvar', 'avar', 'fvar',
+                    'MVAR', 'STAT', 'CPAL', 'meta', 'PCLT'}
+# Layout tables, copied byte-for-byte only if kept glyph IDs don't change and they don't mention dropped glyphs
+_layoutTables = {'GSUB', 'GPOS', 'GDEF', 'BASE', 'JSTF', 'MATH'}
+
+def _mentions(obj, names):
+    """ return true if any string in a decompiled otTables object tree is one of names """
+    seen = set()
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, str):
+            if o in names:
+                return True
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, BaseTable) and id(o) not in seen:
+            seen.add(id(o))
+            stack.extend(vars(o).values())
+    return False
+
+def _dropcheck(f, toDelete):
+    """ return the reason the glyphs can't be dropped without the subsetter, or None if they can """
+    if 'glyf' not in f:
+        return 'no glyf table'
+    for tag in f.keys():
+        if tag != 'GlyphOrder' and tag not in _rewrittenTables | _glyphFreeTables | _layoutTables:
+            return f'{tag} table may refer to glyph IDs'
+
+    cmap = f['cmap'] if 'cmap' in f else None
+    if cmap is not None and any(g in toDelete for t in cmap.tables for g in t.cmap.values()):
+        return 'a glyph to be removed is encoded'
+
+    order = f.getGlyphOrder()
+    newOrder = [g for g in order if g not in toDelete]
+    layoutTags = [tag for tag in f.keys() if tag in _layoutTables]
+    if layoutTags:
+        if newOrder != order[:len(newOrder)]:
+            return 'glyph IDs used by layout tables would change'
+        for tag in layoutTags:
+            # Decompile a private copy so the font's own table still gets copied verbatim
+            table = newTable(tag)
+            table.decompile(f.getTableData(tag), f)
+            table.ensureDecompiled()
+            if _mentions(table.table, toDelete):
+                return f'{tag} table refers to a glyph to be removed'
+    return None
+
+def dropglyphs(f, toDelete, outpath):
+    """ remove glyphs by rewriting just the tables that depend on the glyph order
+
+    All other tables are copied through byte-for-byte. Returns a reason string,
+    having changed nothing, if the font needs the full subsetter instead;
+    otherwise saves the font to outpath and returns None.
+    """
+    reason = _dropcheck(f, toDelete)
+    if reason is not None:
+        return reason
+
+    order = f.getGlyphOrder()
+    newOrder = [g for g in order if g not in toDelete]
+    # Load the tables we rewrite while the old glyph order is in effect
+    for tag in _rewrittenTables:
+        if tag in f:
+            f[tag]
+    oldGlyphIDs = f.getReverseGlyphMap()
+    glyphmap = {oldGlyphIDs[g]: i for i, g in enumerate(newOrder)}
 
+    gtable = f['glyf']
+    def glyphData(gid):
+        g = gtable.glyphs[order[gid]]
+        return g.data if hasattr(g, 'data') else g.compile(gtable)
+    _recalcTables(f, list(glyphmap), glyphData, lambda gid: f['hmtx'].metrics[order[gid]],
+                  (lambda gid: f['vmtx'].metrics[order[gid]]) if 'vmtx' in f else None)
+    for g in toDelete:
+        del gtable.glyphs[g]
+        del f['hmtx'].metrics[g]
+        if 'vmtx' in f:
+            del f['vmtx'].metrics[g]
+    if newOrder != order[:len(newOrder)]:
+        for g in gtable.glyphs.values():
+            if hasattr(g, 'data'):
+                g.remapComponentsFast(glyphmap)
+    if 'post' in f:
+        f['post'].extraNames = []   # rebuilt from the glyph order (as the subsetter does)
+    if 'DSIG' in f:
+        # Drop all signatures since they will be invalid (as the subsetter does)
+        f['DSIG'].usNumSigs = 0
+        f['DSIG'].signatureRecords = []
+    f.setGlyphOrder(newOrder)
+
+    f.recalcBBoxes = False      # done by _recalcTables()
+    f.recalcTimestamp = True
+    with instrument.phase('save'):
+        f.save(outpath, reorderTables=True)
+    return None
+
+def subsetglyphs(f, toKeep, outpath):
+    """ remove all but the toKeep glyphs with the fontTools subsetter and save the font to outpath """
     # copied from nototools.subset
     opt = subset.Options()
     opt.name_IDs = ["*"]
@@ -70,15 +205,529 @@ def ftshake(f, componentNameRE, outpath):
     opt.prune_codepage_ranges = False
 
     # Invoke the subsetter!
-    subsetter = subset.Subsetter(options=opt)
-    subsetter.populate(glyphs=toKeep)
-    subsetter.subset(f)
-    subset.save_font(f, outpath, opt)
+    with instrument.phase('subset'):
+        subsetter = subset.Subsetter(options=opt)
+        subsetter.populate(glyphs=toKeep)
+        subsetter.subset(f)
+    with instrument.phase('save'):
+        subset.save_font(f, outpath, opt)
+
+def ftshake(f, componentNameRE, outpath, graphpath=None, family=None):
+    logger = logging.getLogger('glyphShaker')
+    
+    gnames = set(f.getGlyphOrder())
+    allComponents = set(filter(componentNameRE.search, gnames))
+
+    if family is not None:
+        # Worked out once for a family with the same composites
+        toDelete = set(family.apply(f.getGlyphOrder(), componentGraph(f)))
+    else:
+        # In case nested composites haven't yet been flattened, walk the
+        # whole component graph to make sure all components that are
+        # actually needed are identified
+        with instrument.phase('analyze'):
+            graph = componentGraph(f)
+            roots = gnames - allComponents
+            neededComponents = reachable(graph, roots) & allComponents
+        toDelete = allComponents-neededComponents
+
+    toKeep = gnames - toDelete
+
+    if graphpath is not None:
+        # Report why each component was kept
+        with instrument.phase('graph'):
+            if family is not None:
+                report = family.report
+            else:
+                report = {'removed': sorted(toDelete), 'kept': keptBy(graph, roots, sorted(neededComponents))}
+            with open(graphpath, 'w', encoding='utf-8') as gf:
+                json.dump(report, gf, indent=1)
+        logger.info('Component graph written to %s', graphpath)
+
+    # If nothing else refers to the glyphs to delete, just drop them
+    with instrument.phase('dropglyphs'):
+        reason = dropglyphs(f, toDelete, outpath)
+    if reason is None:
+        f.close()
+        logger.info('Glyphs dropped without subsetting.')
+        logger.info('Of %d glyphs, found %d matching components but can remove %d, leaving %d.', len(gnames), len(allComponents), len(toDelete), len(gnames)-len(toDelete))
+        return
+    logger.info('Using subsetter: %s', reason)
+
+    subsetglyphs(f, toKeep, outpath)
     f.close()
     logger.info('Subsetting complete.')
     logger.info('Of %d glyphs, found %d matching components but can remove %d, leaving %d.', len(gnames), len(allComponents), len(toDelete), len(gnames)-len(toDelete))
 
 
+# Low-memory mode: glyf, loca and the metrics are read through mmap and written
+# back out glyph by glyph, so no glyph is ever decompiled
+
+ARG_1_AND_2_ARE_WORDS, WE_HAVE_A_SCALE, MORE_COMPONENTS, WE_HAVE_AN_X_AND_Y_SCALE, WE_HAVE_A_TWO_BY_TWO = 0x1, 0x8, 0x20, 0x40, 0x80
+
+def rawComponents(glyf, start, end):
+    """ return the (offset, glyph ID) of each component reference of the glyph at glyf[start:end];
+    an empty list for a simple or empty glyph """
+    if end - start < 10 or struct.unpack_from('>h', glyf, start)[0] >= 0:
+        return []
+    res = []
+    pos = start + 10
+    while True:
+        flags, gid = struct.unpack_from('>HH', glyf, pos)
+        res.append((pos + 2, gid))
+        pos += 8 if flags & ARG_1_AND_2_ARE_WORDS else 6
+        if flags & WE_HAVE_A_SCALE:
+            pos += 2
+        elif flags & WE_HAVE_AN_X_AND_Y_SCALE:
+            pos += 4
+        elif flags & WE_HAVE_A_TWO_BY_TWO:
+            pos += 8
+        if not flags & MORE_COMPONENTS:
+            return res
+
+def _recalcTables(f, keep, glyphData, hmetrics, vmetrics=None):
+    """ set the head, hhea, vhea and maxp values fontTools recalculates from the glyphs when saving
+    a TrueType font with recalcBBoxes, for the glyph IDs in keep, from their raw glyf data
+
+    Removing a glyph may change the font's bounding box and the other extremes, but fontTools
+    would have to decompile every glyph to recalculate them. glyphData(gid) returns a glyph's raw
+    glyf data (with its component references still to the old glyph IDs), and hmetrics(gid) and
+    vmetrics(gid) its (advance, side bearing).
+    """
+    boxes = {}          # gid -> (xMin, yMin, xMax, yMax) of non-empty glyphs
+    simple = {}         # gid -> (points, contours)
+    composites = {}     # gid -> component gids
+    for gid in keep:
+        data = glyphData(gid)
+        if len(data) < 10:
+            continue
+        numberOfContours, xMin, yMin, xMax, yMax = struct.unpack_from('>5h', data)
+        boxes[gid] = (xMin, yMin, xMax, yMax)
+        if numberOfContours > 0:
+            simple[gid] = (struct.unpack_from('>H', data, 8 + 2 * numberOfContours)[0] + 1, numberOfContours)
+        else:
+            composites[gid] = [c for pos, c in rawComponents(data, 0, len(data))]
+
+    compositeValues = {}
+    def composite(gid):
+        """ return (points, contours, depth) of a composite glyph, as Glyph.getCompositeMaxpValues() does """
+        if gid not in compositeValues:
+            points = contours = 0
+            depth = 1
+            for c in composites[gid]:
+                if c in simple:
+                    p, n = simple[c]
+                elif c in composites:
+                    p, n, d = composite(c)
+                    depth = max(depth, d + 1)
+                else:
+                    continue    # empty
+                points += p
+                contours += n
+            compositeValues[gid] = (points, contours, depth)
+        return compositeValues[gid]
+
+    head = f['head']
+    if boxes:
+        xMins, yMins, xMaxs, yMaxs = zip(*boxes.values())
+        head.xMin, head.yMin, head.xMax, head.yMax = min(xMins), min(yMins), max(xMaxs), max(yMaxs)
+    else:
+        head.xMin = head.yMin = head.xMax = head.yMax = 0
+    if all(hmetrics(gid)[1] == box[0] for gid, box in boxes.items()):
+        head.flags |= 0x2       # left sidebearing point at x=0
+    else:
+        head.flags &= ~0x2
+
+    maxp = f['maxp']
+    values = [composite(gid) for gid in composites]
+    maxp.maxPoints = max((p for p, n in simple.values()), default=0)
+    maxp.maxContours = max((n for p, n in simple.values()), default=0)
+    maxp.maxCompositePoints = max((p for p, n, d in values), default=0)
+    maxp.maxCompositeContours = max((n for p, n, d in values), default=0)
+    maxp.maxComponentElements = max((len(c) for c in composites.values()), default=0)
+    maxp.maxComponentDepth = max((d for p, n, d in values), default=0)
+
+    extremes = (('hhea', hmetrics, 0, 2, ('advanceWidthMax', 'minLeftSideBearing', 'minRightSideBearing', 'xMaxExtent')),
+                ('vhea', vmetrics, 1, 3, ('advanceHeightMax', 'minTopSideBearing', 'minBottomSideBearing', 'yMaxExtent')))
+    for tag, metrics, lo, hi, fields in extremes:
+        if metrics is None:
+            continue
+        advanceMax = max(metrics(gid)[0] for gid in keep)
+        if boxes:
+            extents = [(metrics(gid), box[hi] - box[lo]) for gid, box in boxes.items()]
+            minStart = min(bearing for (advance, bearing), size in extents)
+            minEnd = min(advance - bearing - size for (advance, bearing), size in extents)
+            maxExtent = max(bearing + size for (advance, bearing), size in extents)
+        else:
+            minStart = minEnd = maxExtent = 0
+        for name, value in zip(fields, (advanceMax, minStart, minEnd, maxExtent)):
+            setattr(f[tag], name, value)
+
+def _unsignedArray(data, itemformat):
+    """ return the big-endian 16-bit ('H') or 32-bit ('I') unsigned values in data as an array """
+    a = array(itemformat)
+    assert a.itemsize == (2 if itemformat == 'H' else 4)
+    a.frombytes(data)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+def _bigendian(a):
+    """ return the contents of an array as big-endian bytes """
+    if sys.byteorder == 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+def _rawMetrics(buf, offset, numberOfMetrics, numGlyphs):
+    """ return the (advances, side bearings) in raw hmtx/vmtx data as unsigned arrays;
+    there are only numberOfMetrics advances """
+    longMetrics = _unsignedArray(buf[offset:offset + 4 * numberOfMetrics], 'H')
+    bearings = longMetrics[1::2] + _unsignedArray(buf[offset + 4 * numberOfMetrics:offset + 2 * numberOfMetrics + 2 * numGlyphs], 'H')
+    return longMetrics[0::2], bearings
+
+def _metrics(advances, bearings, keep):
+    """ return (data, numberOfMetrics) of the hmtx/vmtx table for the glyph IDs in keep,
+    from the advances and bearings returned by _rawMetrics() """
+    numberOfMetrics = len(advances)
+    newAdvances = array('H', (advances[min(g, numberOfMetrics - 1)] for g in keep))
+    newBearings = array('H', (bearings[g] for g in keep))
+    # Trailing glyphs with the same advance as the last long metric need only their side bearing
+    n = len(newAdvances)
+    while n > 1 and newAdvances[n - 1] == newAdvances[n - 2]:
+        n -= 1
+    longMetrics = array('H', bytes(4 * n))
+    longMetrics[0::2] = newAdvances[:n]
+    longMetrics[1::2] = newBearings[:n]
+    return _bigendian(longMetrics) + _bigendian(newBearings[n:]), n
+
+class _ChecksumWriter(object):
+    """ writes a table to a file in pieces, keeping its checksum """
+
+    def __init__(self, f):
+        self.f = f
+        self.checksum = 0
+        self.pending = b''
+
+    def write(self, data):
+        self.f.write(data)
+        data = self.pending + data
+        n = len(data) & ~3
+        self.checksum = (self.checksum + calcChecksum(data[:n])) & 0xFFFFFFFF
+        self.pending = data[n:]
+
+    def finish(self):
+        """ pad the table to a 4-byte boundary and return its checksum """
+        self.checksum = (self.checksum + calcChecksum(self.pending)) & 0xFFFFFFFF
+        self.f.write(b'\0' * (-len(self.pending) & 3))
+        return self.checksum
+
+def _rawLoca(f, buf):
+    """ return the loca of a TrueType font f whose file is mapped in buf, as byte offsets into glyf """
+    locaEntry = f.reader.tables['loca']
+    shortLoca = f['head'].indexToLocFormat == 0
+    loca = _unsignedArray(buf[locaEntry.offset:locaEntry.offset + locaEntry.length], 'H' if shortLoca else 'I')
+    if shortLoca:
+        loca = array('I', (x * 2 for x in loca))
+    return loca
+
+def _rawGraph(f, buf, loca):
+    """ return the component graph of a TrueType font f whose file is mapped in buf,
+    mapping each composite's glyph ID to its components' IDs """
+    glyfOffset = f.reader.tables['glyf'].offset
+    graph = {}
+    for gid in range(len(f.getGlyphOrder())):
+        components = rawComponents(buf, glyfOffset + loca[gid], glyfOffset + loca[gid + 1])
+        if components:
+            graph[gid] = [c for pos, c in components]
+    return graph
+
+def _isRawTrueType(f):
+    return f.flavor is None and f.sfntVersion == '\0\1\0\0' and 'glyf' in f and 'loca' in f
+
+def lowmemshake(infontname, componentNameRE, outpath, graphpath=None, family=None):
+    """ shake a TrueType font without decompiling its glyphs
+
+    Reachability is worked out from the raw composite glyph headers, and glyf,
+    loca, hmtx and vmtx are streamed to outpath from an mmap of the input, so
+    memory use depends on the number of glyphs rather than on the outline data.
+    The same fonts as dropglyphs() can be handled; otherwise a reason string is
+    returned, having written nothing, and the normal mode has to be used.
+    With a FamilyAnalysis, its glyphs to delete are used instead of analyzing the font
+    (FamilyMismatch is raised if the font's composites differ from the family source's).
+    """
+    logger = logging.getLogger('glyphShaker')
+    with instrument.phase('load'):
+        f = TTFont(infontname, lazy=True)
+    with f, open(infontname, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if not _isRawTrueType(f):
+            return 'not an uncompressed TrueType font'
+        entries = f.reader.tables
+        order = f.getGlyphOrder()
+        numGlyphs = len(order)
+        shortLoca = f['head'].indexToLocFormat == 0
+        glyfOffset = entries['glyf'].offset
+        componentIDs = {gid for gid, gname in enumerate(order) if componentNameRE.search(gname)}
+
+        loca = _rawLoca(f, buf)
+        if family is not None:
+            graph = _rawGraph(f, buf, loca)
+            toDelete = set(family.applyIDs(order, graph))
+        else:
+            with instrument.phase('analyze'):
+                graph = _rawGraph(f, buf, loca)
+                roots = set(range(numGlyphs)) - componentIDs
+                neededIDs = reachable(graph, roots) & componentIDs
+                toDelete = {order[gid] for gid in componentIDs - neededIDs}
+
+        # Check before writing anything, so nothing is left behind if the normal mode has to be used
+        reason = _dropcheck(f, toDelete)
+        if reason is not None:
+            return reason
+
+        if graphpath is not None:
+            with instrument.phase('graph'):
+                if family is not None:
+                    report = family.report
+                else:
+                    namedGraph = {order[gid]: [order[c] for c in comps] for gid, comps in graph.items()}
+                    report = {'removed': sorted(toDelete),
+                              'kept': keptBy(namedGraph, {order[gid] for gid in roots}, sorted(order[gid] for gid in neededIDs))}
+                with open(graphpath, 'w', encoding='utf-8') as gf:
+                    json.dump(report, gf, indent=1)
+            logger.info('Component graph written to %s', graphpath)
+
+        with instrument.phase('dropglyphs'):
+            keep = [gid for gid, gname in enumerate(order) if gname not in toDelete]
+            newOrder = [order[gid] for gid in keep]
+            glyphmap = {old: new for new, old in enumerate(keep)} if keep != list(range(len(keep))) else None
+
+            # Rewrite everything but glyf (which is streamed) while the old glyph order is in effect
+            data = {}
+            rewritten = ('head', 'hhea', 'vhea', 'maxp', 'post', 'cmap', 'DSIG')
+            for tag in rewritten:
+                if tag in f:
+                    f[tag]
+            hadvances, hbearings = _rawMetrics(buf, entries['hmtx'].offset, f['hhea'].numberOfHMetrics, numGlyphs)
+            data['hmtx'], f['hhea'].numberOfHMetrics = _metrics(hadvances, hbearings, keep)
+            vmetrics = None
+            if 'vmtx' in f:
+                vadvances, vbearings = _rawMetrics(buf, entries['vmtx'].offset, f['vhea'].numberOfVMetrics, numGlyphs)
+                data['vmtx'], f['vhea'].numberOfVMetrics = _metrics(vadvances, vbearings, keep)
+                vsigned = array('h', vbearings.tobytes())     # the side bearings are signed
+                vmetrics = lambda gid: (vadvances[min(gid, len(vadvances) - 1)], vsigned[gid])
+            hsigned = array('h', hbearings.tobytes())
+            f.recalcBBoxes = False      # done by _recalcTables()
+            _recalcTables(f, keep, lambda gid: buf[glyfOffset + loca[gid]:glyfOffset + loca[gid + 1]],
+                          lambda gid: (hadvances[min(gid, len(hadvances) - 1)], hsigned[gid]), vmetrics)
+            f['head'].checkSumAdjustment = 0
+
+            newLoca = array('I', bytes(4 * (len(keep) + 1)))
+            for i, gid in enumerate(keep):
+                newLoca[i + 1] = newLoca[i] + loca[gid + 1] - loca[gid]
+            data['loca'] = _bigendian(array('H', (x // 2 for x in newLoca)) if shortLoca else newLoca)
+
+            if 'post' in f:
+                f['post'].extraNames = []   # rebuilt from the glyph order (as the subsetter does)
+            if 'DSIG' in f:
+                # Drop all signatures since they will be invalid (as the subsetter does)
+                f['DSIG'].usNumSigs = 0
+                f['DSIG'].signatureRecords = []
+            f.setGlyphOrder(newOrder)
+            f['maxp'].numGlyphs = len(keep)     # post checks it
+            for tag in rewritten:
+                if tag in f:
+                    data[tag] = f[tag].compile(f)
+
+            # Lay out the tables in their original order, and write the directory last
+            tags = sorted(entries, key=lambda tag: entries[tag].offset)
+            lengths = {tag: len(data[tag]) if tag in data else entries[tag].length for tag in tags}
+            lengths['glyf'] = newLoca[-1]
+            offset = 12 + 16 * len(tags)
+            offsets = {}
+            for tag in tags:
+                offsets[tag] = offset
+                offset += (lengths[tag] + 3) & ~3
+
+            checksums = {}
+            with instrument.phase('save'), open(outpath, 'wb') as out:
+                out.write(bytes(offsets[tags[0]]))
+                for tag in tags:
+                    writer = _ChecksumWriter(out)
+                    if tag == 'glyf':
+                        chunk = []
+                        for gid in keep:
+                            glyph = buf[glyfOffset + loca[gid]:glyfOffset + loca[gid + 1]]
+                            components = rawComponents(glyph, 0, len(glyph)) if glyphmap is not None else None
+                            if components:
+                                glyph = bytearray(glyph)
+                                for pos, c in components:
+                                    struct.pack_into('>H', glyph, pos, glyphmap[c])
+                            chunk.append(glyph)
+                            if len(chunk) >= 1024:
+                                writer.write(b''.join(chunk))
+                                chunk = []
+                        writer.write(b''.join(chunk))
+                    elif tag in data:
+                        writer.write(bytes(data[tag]))
+                    else:
+                        entry = entries[tag]
+                        for start in range(entry.offset, entry.offset + entry.length, 1 << 20):
+                            writer.write(buf[start:min(start + (1 << 20), entry.offset + entry.length)])
+                    checksums[tag] = writer.finish()
+
+                searchRange, entrySelector, rangeShift = getSearchRange(len(tags), 16)
+                directory = struct.pack('>4sHHHH', b'\0\1\0\0', len(tags), searchRange, entrySelector, rangeShift)
+                for tag in sorted(tags):
+                    directory += struct.pack('>4sLLL', tag.encode('latin-1'), checksums[tag], offsets[tag], lengths[tag])
+                checkSumAdjustment = (0xB1B0AFBA - calcChecksum(directory) - sum(checksums.values())) & 0xFFFFFFFF
+                out.seek(0)
+                out.write(directory)
+                out.seek(offsets['head'] + 8)
+                out.write(struct.pack('>L', checkSumAdjustment))
+
+    logger.info('Glyphs dropped in low-memory mode.')
+    logger.info('Of %d glyphs, found %d matching components but can remove %d, leaving %d.', numGlyphs, len(componentIDs), len(toDelete), len(keep))
+    return None
+
+
+# Family mode: the members of a family normally share a glyph order and composites,
+# so the reachability analysis is done once, on the first member (the source), from
+# the glyph order and component graph ftshake() or lowmemshake() loaded to shake it.
+# Every other member is only checked, on its own load, to have the same glyph order
+# and composites before the source's components are dropped from it.
+
+class FamilyMismatch(Exception):
+    """ raised for a family member whose glyph order or composites differ from the source's """
+
+class FamilyAnalysis(object):
+    """ the components to delete from every member of a family, worked out from the source
+    when it is shaken, which must be before any other member. Once analyzed it is picklable,
+    so it can be handed to worker processes. The --graph report is worked out when first
+    used, or during the analysis with graph (so worker processes don't each redo it). """
+
+    def __init__(self, source, componentNameRE, graph=False):
+        self.source = source
+        self.componentNameRE = componentNameRE
+        self.toDelete = None
+        self._withReport = graph
+        self._report = None
+        self._ids = None
+
+    def apply(self, order, graph):
+        """ return the components to delete from a font with this glyph order and componentGraph(),
+        analyzing it as the source if nothing has been analyzed yet.
+        FamilyMismatch is raised if the font's glyph order or composites differ from the source's. """
+        if self.toDelete is None:
+            with instrument.phase('analyze'):
+                allComponents = set(filter(self.componentNameRE.search, order))
+                roots = set(order) - allComponents
+                neededComponents = reachable(graph, roots) & allComponents
+            self.toDelete = sorted(allComponents - neededComponents)
+            self._order, self._graph, self._roots, self._needed = list(order), graph, roots, sorted(neededComponents)
+            if self._withReport:
+                with instrument.phase('graph'):
+                    self.report
+        else:
+            with instrument.phase('familycheck'):
+                if order != self._order or graph != self._graph:
+                    raise FamilyMismatch(f'glyph order or composites differ from {self.source}; not shaken')
+        return self.toDelete
+
+    def applyIDs(self, order, graph):
+        """ apply() for a component graph of glyph IDs, as returned by _rawGraph() """
+        if self.toDelete is not None and order == self._order:
+            with instrument.phase('familycheck'):
+                if self._ids is None:
+                    gids = {gname: gid for gid, gname in enumerate(order)}
+                    self._ids = {gids[gname]: [gids[c] for c in comps] for gname, comps in self._graph.items()}
+                if graph == self._ids:
+                    return self.toDelete
+        return self.apply(order, {order[gid]: [order[c] for c in comps] for gid, comps in graph.items()})
+
+    def __getstate__(self):
+        # the glyph ID graph is rebuilt by each worker process that needs it
+        return dict(self.__dict__, _ids=None)
+
+    @property
+    def report(self):
+        """ the component graph report written with --graph """
+        if self._report is None:
+            self._report = {'removed': self.toDelete, 'kept': keptBy(self._graph, self._roots, self._needed)}
+        return self._report
+
+
+def shakefile(infontname, componentNameRE, outpath, graph=False, pool=None, lowmem=False, family=None):
+    """ open and shake one font file; returns True if successful.
+    With a fontpool.FontPool, the font is a private copy of the pooled one.
+    With lowmem, lowmemshake() is tried first (and the pool isn't used).
+    With a FamilyAnalysis, its components are deleted if the font has the same composites
+    (the first font shaken with it, its source, is analyzed). """
+    logger = logging.getLogger('glyphShaker')
+    graphpath = f'{outpath}.components.json' if graph else None
+    if lowmem:
+        logger.info('\nProcessing %s --> %s', infontname, outpath)
+        try:
+            reason = lowmemshake(infontname, componentNameRE, outpath, graphpath, family)
+        except FamilyMismatch as e:
+            logger.error('%s: %s', infontname, e)
+            return False
+        except Exception as e:
+            logger.error('Unable to shake %s: %s', infontname, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return False
+        if reason is None:
+            return True
+        logger.warning('%s: low-memory mode not possible (%s); loading the whole font', infontname, reason)
+    try:
+        with instrument.phase('load'):
+            infont = TTFont(infontname) if pool is None else pool.copy(infontname)
+    except:
+        logger.warning("Couldn't open %s as a TTF font; parameter skipped", infontname)
+        return False
+
+    if not lowmem:
+        logger.info('\nProcessing %s --> %s', infontname, outpath)
+    try:
+        ftshake(infont, componentNameRE, outpath, graphpath, family)
+    except FamilyMismatch as e:
+        logger.error('%s: %s', infontname, e)
+        return False
+    except Exception as e:
+        logger.error('Unable to shake %s: %s', infontname, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return False
+    return True
+
+
+class _RecordCollector(logging.Handler):
+    """ logging handler that keeps records so a worker process can hand them back to the parent """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable: format message and traceback now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+def _shakejob(infontname, componentNameRE, outpath, graph, loglevel, stats=False, lowmem=False, family=None):
+    """ process pool worker: shake one font, returning (success, log records, instrumentation stats or None) """
+    # Collect everything logged (including by fontTools) rather than writing it from the worker
+    root = logging.getLogger()
+    root.setLevel(loglevel)
+    collector = _RecordCollector()
+    root.handlers = [collector]
+    try:
+        with instrument.Instrument(collect=stats) as inst:
+            ok = shakefile(infontname, componentNameRE, outpath, graph, lowmem=lowmem, family=family)
+    finally:
+        root.handlers = []
+    return ok, collector.records, inst.stats() if stats else None
+
+
 if __name__ == '__main__':
 
     parser=argparse.ArgumentParser(
@@ -96,6 +745,26 @@ the input fonts and be stored in the folder named by OUTDIR.
 Note: This program uses the fontTools subsetter, and might remove things you 
 wanted to keep, such as TypeTuner-only lookups. Suggest the tool be used 
 before adding OpenType, Graphite or TypeTuner smarts.
+
+If no other table refers to the glyphs being removed (and no remaining 
+glyph ID would change in a font that has layout tables), the glyphs are 
+dropped directly, rewriting only glyf, loca, hmtx, post, maxp, cmap and 
+their headers; all other tables are copied unchanged. Otherwise the 
+subsetter is used. Run with -L INFO to see which was used.
+
+With --lowmem, fonts that qualify for dropping glyphs directly are shaken
+without decompiling any glyph: composites are followed through their raw
+headers, and glyf, loca and the metrics are streamed from an mmap of the
+input, so memory use depends on the glyph count rather than the outlines.
+Other fonts fall back to the normal mode with a warning.
+
+With --family, the components to remove are worked out once, from the first
+font, while it is shaken, and removed from every font. Each other font is
+checked to have the same glyph order and composites when it is loaded;
+fonts that differ are reported and not shaken.
+
+With --jobs, --stats-json includes the work done in the worker processes
+but --profile covers only the main process.
 ''')
     parser.add_argument("infonts", help="Path to input font file(s). Can be repeated; can contain wildcards", nargs='+')
     outputoptions = parser.add_mutually_exclusive_group()
@@ -103,10 +772,21 @@ before adding OpenType, Graphite or TypeTuner smarts.
     outputoptions.add_argument("-o", "--outfont", help="name of output font file")
     parser.add_argument("-c", "--compregex", metavar="RegEx", help="RegEx to recognize names of component-only glyphs (default: ^_)", 
                         default=r'^_')
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar='N',
+                        help="Number of fonts to shake in parallel; 0 means one per CPU (default: 1)")
+    parser.add_argument("-g", "--graph", action="store_true",
+                        help="For each output font, also write OUTPUT.components.json listing the removed components and, "
+                             "for each kept component, the glyphs using it and the root glyphs keeping it alive")
+    parser.add_argument("--lowmem", action="store_true",
+                        help="Read glyf and loca through mmap and stream the output, without decompiling any glyphs")
+    parser.add_argument("--family", action="store_true",
+                        help="Analyze the first font only and apply its keep-set to all fonts, which must have identical composites")
     parser.add_argument("-q", "--quiet", action="store_true", help="Set Logging level to ERROR (default: False)")
     parser.add_argument("-L","--loglevel",default="WARN",help="Logging level (default: WARN)", choices=("DEBUG", "INFO", "WARN", "ERROR"))
     parser.add_argument("--logfile",help="Pathname of logfile to create")
+    instrument.addArguments(parser)
     args = parser.parse_args()
+    inst = instrument.fromArgs(args, 'fontshaker')
 
     # Compile RE that will identify (by name) candidate component glyphs to delete
     compRE = re.compile(args.compregex)
@@ -138,20 +818,54 @@ before adding OpenType, Graphite or TypeTuner smarts.
         outdir = Path(args.outdir)
         outdir.mkdir(parents=True, exist_ok=True) 
 
-    # Finally, loop through all the fonts and shake out those unwanted glyphs!
+    # Decide output path for each font
+    jobs = []
     for infontname in fileList:
-        try:
-            infont = TTFont(infontname)
-        except:
-            logger.warning("Couldn't open %s as a TTF font; parameter skipped", infontname)
-            continue
-
         if useOutfont:
             outpath = args.outfont
         else:
             basename= Path(infontname).name
             outpath = outdir / basename
-        logger.info('\nProcessing %s --> %s', infontname, outpath)
-        ftshake(infont, compRE, outpath)
+        jobs.append((infontname, outpath))
+
+    # Finally, loop through all the fonts and shake out those unwanted glyphs!
+    failures = 0
+    with inst:
+        family = None
+        if args.family:
+            # The source is shaken first, on its own, and analyzed as it is loaded
+            family = FamilyAnalysis(jobs[0][0], compRE, args.graph)
+            if not shakefile(jobs[0][0], compRE, jobs[0][1], args.graph, lowmem=args.lowmem, family=family):
+                failures += 1
+            if family.toDelete is None:
+                logger.error('Unable to analyze %s', family.source)
+                sys.exit(1)
+            logger.info('Family keep-set from %s: removing %d glyphs', family.source, len(family.toDelete))
+        pending = jobs[1:] if family is not None else jobs
+        numjobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        if numjobs == 1 or len(pending) <= 1:
+            for infontname, outpath in pending:
+                if not shakefile(infontname, compRE, outpath, args.graph, lowmem=args.lowmem, family=family):
+                    failures += 1
+        else:
+            # Workers hand back their log records, which are then emitted in input order
+            with ProcessPoolExecutor(max_workers=min(numjobs, len(pending))) as executor:
+                futures = [executor.submit(_shakejob, infontname, compRE, outpath, args.graph, loglevel.upper(), inst.collecting, args.lowmem, family) for infontname, outpath in pending]
+                for (infontname, outpath), future in zip(pending, futures):
+                    try:
+                        ok, records, stats = future.result()
+                    except Exception as e:
+                        logger.error('Unable to shake %s: %s', infontname, e)
+                        ok, records, stats = False, [], None
+                    for record in records:
+                        logging.getLogger(record.name).handle(record)
+                    if stats is not None:
+                        inst.merge(stats)
+                    if not ok:
+                        failures += 1
+
+    if failures:
+        logger.error('%d of %d fonts could not be shaken', failures, len(jobs))
+        sys.exit(1)
 
 # done!
\ No newline at end of file
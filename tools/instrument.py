@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+""" shared instrumentation for the tools: phase timers, peak memory, table decompile counts and cProfile
+
+A tool adds the --profile and --stats-json options with addArguments() and
+wraps its work in the Instrument returned by fromArgs(). Code anywhere can then
+time a phase with:
+
+    with instrument.phase('parse'):
+        ...
+
+which costs next to nothing when instrumentation isn't enabled.
+
+--stats-json writes the phase times and call counts, how many times (and for how
+long) each font table was decompiled, and the peak memory traced by tracemalloc.
+Phase times from threads are summed, so they can add up to more than the wall time.
+--profile dumps cProfile data, which can be read with 'python -m pstats FILE'.
+"""
+
+from fontTools.ttLib import TTFont
+import fontTools
+import argparse
+import contextlib
+import cProfile
+import json
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+_active = None      # the Instrument currently collecting, if any
+
+def addArguments(parser):
+    """ add the --profile and --stats-json options to an argparse parser """
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--profile', metavar='FILE', help='write cProfile data to FILE')
+    group.add_argument('--stats-json', metavar='FILE',
+                       help="write phase timings, table decompile counts and peak memory (traced, so slower) to FILE as JSON ('-' for stderr)")
+    return parser
+
+def fromArgs(args, tool=None):
+    """ return an Instrument configured from parsed --profile and --stats-json options """
+    return Instrument(tool, profile=args.profile, statsjson=args.stats_json)
+
+def fromArgv(argv, tool=None):
+    """ for tools that parse their own command line: take out the instrumentation options.
+    Returns (Instrument, remaining arguments) """
+    parser = addArguments(argparse.ArgumentParser(add_help=False))
+    args, rest = parser.parse_known_args(argv)
+    return fromArgs(args, tool), rest
+
+@contextlib.contextmanager
+def phase(name):
+    """ time the enclosed code as phase name of the active Instrument (if any) """
+    if _active is None:
+        yield
+    else:
+        with _active.phase(name):
+            yield
+
+
+class Instrument(object):
+    """ collects phase timings, table decompile counts, peak memory and optionally a cProfile profile
+
+    Use as a context manager around the tool's work; the results are written on exit.
+    With neither profile nor statsjson set, nothing is collected unless collect is true
+    (used in worker processes, which hand stats() back to the parent to merge).
+    """
+
+    def __init__(self, tool=None, profile=None, statsjson=None, collect=False):
+        self.tool = tool or sys.argv[0]
+        self.profile = profile
+        self.statsjson = statsjson
+        self.collecting = bool(statsjson or collect)
+        self.enabled = bool(profile or self.collecting)
+        self.phases = {}    # name -> [seconds, calls]
+        self.tables = {}    # tag -> [seconds, decompiles]
+        self.peakMemory = None
+        self.wall = None
+        self._lock = threading.Lock()
+        self._profiler = None
+
+    def __enter__(self):
+        global _active
+        if not self.enabled:
+            return self
+        self._previous, _active = _active, self
+        self._start = time.perf_counter()
+        if self.collecting:
+            self._readTable = TTFont._readTable
+            instrument = self
+
+            def _readTable(font, tag):
+                start = time.perf_counter()
+                try:
+                    return instrument._readTable(font, tag)
+                finally:
+                    instrument._add(instrument.tables, tag, time.perf_counter() - start)
+            TTFont._readTable = _readTable
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        if not self.enabled:
+            return False
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile)
+        self.wall = time.perf_counter() - self._start
+        if self.collecting:
+            TTFont._readTable = self._readTable
+            self.peakMemory = max(self.peakMemory or 0, tracemalloc.get_traced_memory()[1])
+            if self._tracing:
+                tracemalloc.stop()
+        if self.statsjson:
+            self.write(self.statsjson)
+        _active = self._previous
+        return False
+
+    def _add(self, totals, key, seconds, calls=1):
+        with self._lock:
+            entry = totals.setdefault(key, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ time the enclosed code as phase name """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(self.phases, name, time.perf_counter() - start)
+
+    def stats(self):
+        """ return the collected figures as a JSON-serializable dict """
+        return {
+            'tool': self.tool,
+            'argv': sys.argv[1:],
+            'python': platform.python_version(),
+            'fontTools': fontTools.version,
+            'wall': self.wall,
+            'peakMemory': self.peakMemory,
+            'phases': {name: {'seconds': s, 'calls': n} for name, (s, n) in self.phases.items()},
+            'tables': {tag: {'seconds': s, 'decompiles': n} for tag, (s, n) in sorted(self.tables.items())},
+        }
+
+    def merge(self, stats):
+        """ add in the phases, table counts and peak memory from another Instrument's stats(),
+        e.g. one that ran in a worker process """
+        for name, p in stats['phases'].items():
+            self._add(self.phases, name, p['seconds'], p['calls'])
+        for tag, t in stats['tables'].items():
+            self._add(self.tables, tag, t['seconds'], t['decompiles'])
+        if stats['peakMemory'] is not None:
+            self.peakMemory = max(self.peakMemory or 0, stats['peakMemory'])
+
+    def write(self, statsjson):
+        if statsjson == '-':
+            json.dump(self.stats(), sys.stderr, indent=1)
+            sys.stderr.write('\n')
+        else:
+            with open(statsjson, 'w', encoding='utf-8') as f:
+                json.dump(self.stats(), f, indent=1)
@@ -3,8 +3,11 @@
 
 usage: setSpaceWidth spacewidths ttffile(s) ...
 
-spacewidths = comma-separated list of 1 or 2 integer values to serve as space widths
-     First integer is desired width of 'space', second, if supplied is of 'space.arab'
+spacewidths = comma-separated list of 1 or 2 width values to serve as space widths
+     First value is desired width of 'space', second, if supplied is of 'space.arab'
+     Each value may be an integer, a /-separated list of integers, or a range
+     written first..last or first..last:step (step defaults to 10). A font is
+     created for every combination of the values given.
 
 ttffile(s) = one or more file patterns specifying input ttf files
 
@@ -19,75 +22,245 @@ examples:
 
     # Similar to above but process all ttfs in folder:
     setSpaceWidth 300,210 *.ttf
+
+    # 42 variants: space from 200 to 400 in steps of 10, each with space.arab of 210 and of 230
+    setSpaceWidth 200..400:10,210/230 Zork-Regular.ttf
+
+--profile FILE and --stats-json FILE may be added to record where the time goes
+(see instrument.py).
+
+Each input font is read only once. Where possible the variants are written by
+patching just the hmtx, name and head tables and copying all other table data
+verbatim.
 '''
-from fontTools.ttLib import TTFont
+from fontTools.ttLib import TTFont, newTable, getSearchRange
+from fontTools.ttLib.sfnt import calcChecksum
+from fontTools.misc.timeTools import timestampNow
 from glob import glob
+import itertools
 import re
 from os.path import splitext
+import struct
 import sys
+import instrument
 
-if len(sys.argv) < 3:
-    sys.stderr.write('insufficient arguments.\n')
-    sys.stderr.write('usage: usage: setSpaceWidth spacewidths ttffile(s) ...\n')
-    exit(1)
 
-m = re.match('(\d+)(?:,(\d+))?',sys.argv[1])
-if not m:
-    sys.stderr.write("1st arg must be comma-separated list of one or two positive integer values to use as widths\n")
-    exit(1)
+def parsewidths(spec):
+    ''' return list of widths from one width value: 300, 300/320/340, or 200..400[:step] '''
+    m = re.fullmatch(r'(\d+)\.\.(\d+)(?::(\d+))?', spec)
+    if m:
+        first, last, step = int(m.group(1)), int(m.group(2)), int(m.group(3) or 10)
+        if step == 0 or first > last:
+            raise ValueError(spec)
+        return list(range(first, last + 1, step))
+    if not re.fullmatch(r'\d+(/\d+)*', spec):
+        raise ValueError(spec)
+    return [int(x) for x in spec.split('/')]
 
-spacewidth = int(m.group(1))
-suffix = f'-{spacewidth}'
+def parsespec(spec):
+    ''' return list of (spacewidth, arabwidth) variants requested by the spacewidths parameter;
+    arabwidth is None if not supplied '''
+    parts = spec.split(',')
+    if len(parts) > 2:
+        raise ValueError(spec)
+    spacewidths = parsewidths(parts[0])
+    arabwidths = parsewidths(parts[1]) if len(parts) == 2 else [None]
+    return list(itertools.product(spacewidths, arabwidths))
 
-arabwidth = m.group(2)
-if arabwidth is not None:
-    arabwidth = int(arabwidth)
-    suffix += f'-{arabwidth}'
+def suffixfor(spacewidth, arabwidth):
+    return f'-{spacewidth}' if arabwidth is None else f'-{spacewidth}-{arabwidth}'
 
-for arg in sys.argv[2:]:
-    for fontfile in glob(arg):
-        try:
-            ttfont = TTFont(fontfile)
-        except Exception as e:
-            sys.stderr.write(f'"{fontfile}" doesn\'t appear to be a ttf: {e}\n')
-            continue
-        base, ext = splitext(fontfile)
-        outfont = f'{base}{suffix}{ext}'
 
-        print(f'processing {fontfile}  --> {outfont}')
+def renamefont(nametable, suffix):
+    ''' append suffix to the family name (and postscript name) throughout the name table '''
+    namelist = nametable.names
+    # Find stylename:
+    style = next(str(record) for record in namelist if record.nameID == 2)
+    fontname = next(str(record) for record in namelist if record.nameID == 1)
+    psfontname = fontname.replace(' ','')
+    newfontname = f'{fontname}{suffix}'
+
+    # Now change all names:
+    for record in namelist:
+        if record.nameID == 6:  # postscriptname
+            record.string = str(record).replace(psfontname, f'{psfontname}{suffix}')
+        else:
+            record.string = str(record).replace(fontname, newfontname)
 
-        # update hmtx:
-        metrics = ttfont['hmtx'].metrics
-        if 'space' in metrics:
-            metrics['space'] = (spacewidth, metrics['space'][1])
+
+def writevariant(ttfont, outfont, spacewidth, arabwidth):
+    ''' write one variant by decompiling and recompiling the font (the slow but general way) '''
+    # update hmtx:
+    metrics = ttfont['hmtx'].metrics
+    if 'space' in metrics:
+        metrics['space'] = (spacewidth, metrics['space'][1])
+    else:
+        sys.stderr.write(f'glyph "space" not found in fontfile; font ignored\n')
+        return
+    if arabwidth is not None:
+        if 'space.arab' in metrics:
+            metrics['space.arab'] = (arabwidth, metrics['space.arab'][1])
         else:
-            sys.stderr.write(f'glyph "space" not found in fontfile; font ignored')
+            sys.stderr.write(f'glyph "space.arab" not found in fontfile; glyph ignored\n')
+
+    # Append suffix to font-name
+    renamefont(ttfont['name'], suffixfor(spacewidth, arabwidth))
+
+    # Write the font
+    try:
+        ttfont.save(outfont)
+    except Exception as e:
+        sys.stderr.write(f'trouble saving "{outfont}": {e}\n')
+
+
+class RawVariantWriter(object):
+    ''' writes space-width variants of a TrueType font by patching raw table data
+
+    Only hmtx (the advance widths, in place), name and head (timestamp and
+    checksum adjustment) change; all other tables, and their directory
+    checksums, are copied verbatim from the source font.
+    '''
+
+    def __init__(self, ttfont):
+        self.ttfont = ttfont
+        reader = ttfont.reader
+        # Write tables in the order they appear in the source
+        self.tags = sorted(reader.keys(), key=lambda tag: reader.tables[tag].offset)
+        self.data = {tag: reader[tag] for tag in self.tags}
+        self.checksums = {tag: reader.tables[tag].checkSum for tag in self.tags}
+        self.sfntVersion = ttfont.sfntVersion
+        self.numberOfHMetrics = ttfont['hhea'].numberOfHMetrics
+        self.glyphIDs = ttfont.getReverseGlyphMap()
+
+    @classmethod
+    def usable(cls, ttfont, glyphs):
+        ''' return true if variants of ttfont changing the named glyphs' widths can be written raw '''
+        if ttfont.flavor is not None or 'hmtx' not in ttfont or 'name' not in ttfont:
+            return False
+        numberOfHMetrics = ttfont['hhea'].numberOfHMetrics
+        glyphIDs = ttfont.getReverseGlyphMap()
+        # glyphs sharing the final advance width can't be changed in place
+        return all(glyphIDs[g] < numberOfHMetrics for g in glyphs if g in glyphIDs)
+
+    def write(self, outfont, widths, suffix):
+        ''' write a variant with glyph advance widths from the widths dict, adding suffix to its names '''
+        hmtx = bytearray(self.data['hmtx'])
+        for glyph, width in widths.items():
+            struct.pack_into('>H', hmtx, self.glyphIDs[glyph] * 4, width)
+
+        name = newTable('name')
+        name.decompile(self.data['name'], self.ttfont)
+        renamefont(name, suffix)
+
+        head = bytearray(self.data['head'])
+        struct.pack_into('>L', head, 8, 0)                  # checkSumAdjustment
+        struct.pack_into('>q', head, 28, timestampNow())    # modified
+
+        data = dict(self.data, hmtx=bytes(hmtx), name=name.compile(self.ttfont), head=bytes(head))
+        checksums = dict(self.checksums)
+        for tag in ('hmtx', 'name', 'head'):
+            checksums[tag] = calcChecksum(data[tag])
+
+        # Lay out the tables and build the directory
+        numTables = len(self.tags)
+        offset = 12 + 16 * numTables
+        offsets = {}
+        for tag in self.tags:
+            offsets[tag] = offset
+            offset += (len(data[tag]) + 3) & ~3
+        searchRange, entrySelector, rangeShift = getSearchRange(numTables, 16)
+        directory = struct.pack('>4sHHHH', self.sfntVersion if isinstance(self.sfntVersion, bytes) else self.sfntVersion.encode('latin-1'),
+                                numTables, searchRange, entrySelector, rangeShift)
+        for tag in sorted(self.tags):
+            directory += struct.pack('>4sLLL', tag.encode('latin-1'), checksums[tag], offsets[tag], len(data[tag]))
+
+        checkSumAdjustment = (0xB1B0AFBA - calcChecksum(directory) - sum(checksums.values())) & 0xFFFFFFFF
+        struct.pack_into('>L', head, 8, checkSumAdjustment)
+        data['head'] = bytes(head)
+
+        with open(outfont, 'wb') as f:
+            f.write(directory)
+            for tag in self.tags:
+                f.write(data[tag])
+                f.write(b'\0' * (-len(data[tag]) & 3))
+
+
+def makevariants(fontfile, variants, pool=None):
+    ''' write the space-width variants of one font, returning the list of files written.
+    variants is a list of (spacewidth, arabwidth) as returned by parsespec(). With a
+    fontpool.FontPool, the font is taken from (and read only once into) the pool. '''
+    try:
+        with instrument.phase('load'):
+            ttfont = TTFont(fontfile) if pool is None else pool.get(fontfile)
+    except Exception as e:
+        sys.stderr.write(f'"{fontfile}" doesn\'t appear to be a ttf: {e}\n')
+        return []
+    base, ext = splitext(fontfile)
+    written = []
+
+    glyphs = ttfont.getGlyphOrder()
+    if 'space' not in glyphs:
+        sys.stderr.write(f'glyph "space" not found in "{fontfile}"; font ignored\n')
+        if pool is None:
             ttfont.close()
+        return written
+    if 'space.arab' not in glyphs and any(arabwidth is not None for _, arabwidth in variants):
+        sys.stderr.write(f'glyph "space.arab" not found in "{fontfile}"; glyph ignored\n')
+
+    raw = RawVariantWriter(ttfont) if RawVariantWriter.usable(ttfont, ('space', 'space.arab')) else None
+    for spacewidth, arabwidth in variants:
+        suffix = suffixfor(spacewidth, arabwidth)
+        outfont = f'{base}{suffix}{ext}'
+        print(f'processing {fontfile}  --> {outfont}')
+
+        if raw is None:
+            # Start afresh from the source for each variant
+            with instrument.phase('write variant'):
+                variant = TTFont(fontfile) if pool is None else pool.copy(fontfile)
+                writevariant(variant, outfont, spacewidth, arabwidth)
+            variant.close()
+            written.append(outfont)
             continue
-        if arabwidth is not None:
-            if 'space.arab' in metrics:
-                metrics['space.arab'] = (arabwidth, metrics['space.arab'][1])
-            else:
-                sys.stderr.write(f'glyph "space.arab" not found in fontfile; glyph ignored')
-
-        # Append suffix to font-name
-        namelist = ttfont['name'].names
-        # Find stylename:
-        style = next(str(record) for record in namelist if record.nameID == 2)
-        fontname = next(str(record) for record in namelist if record.nameID == 1)
-        psfontname = fontname.replace(' ','')
-        newfontname = f'{fontname}{suffix}'
-
-        # Now change all names:
-        for record in namelist:
-            if record.nameID == 6:  # postscriptname
-                record.string = str(record).replace(psfontname, f'{psfontname}{suffix}')
-            else:
-                record.string = str(record).replace(fontname, newfontname)
-
-        # Write the font
+
+        widths = {'space': spacewidth}
+        if arabwidth is not None and 'space.arab' in glyphs:
+            widths['space.arab'] = arabwidth
         try:
-            ttfont.save(outfont)
+            with instrument.phase('write raw variant'):
+                raw.write(outfont, widths, suffix)
+            written.append(outfont)
         except Exception as e:
-            sys.stderr.write(f'trouble saving "{outfont}": {e}')
+            sys.stderr.write(f'trouble saving "{outfont}": {e}\n')
+    if pool is None:
         ttfont.close()
+    return written
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    inst, args = instrument.fromArgv(args, 'setSpaceWidth')
+
+    if len(args) < 2:
+        sys.stderr.write('insufficient arguments.\n')
+        sys.stderr.write('usage: usage: setSpaceWidth spacewidths ttffile(s) ...\n')
+        return 1
+
+    try:
+        variants = parsespec(args[0])
+    except ValueError:
+        sys.stderr.write("1st arg must be comma-separated list of one or two widths (integers, /-separated lists or first..last[:step] ranges) to use as widths\n")
+        return 1
+
+    with inst:
+        fontfiles = [fontfile for arg in args[1:] for fontfile in glob(arg)]
+        if not fontfiles:
+            sys.stderr.write('no font files found\n')
+            return 1
+        for fontfile in fontfiles:
+            makevariants(fontfile, variants)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
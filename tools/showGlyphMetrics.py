@@ -1,45 +1,113 @@
 #! /usr/bin/env python
-''' print in tabular form glyph metrics from multiple ttf fonts'''
+''' print in tabular form glyph metrics from multiple ttf fonts
 
+For each glyph (matched by name across the fonts) and each of advance width,
+lsb and bounding box, a row gives the value in each font followed by the
+minimum, maximum and range across the fonts. The last column lists the fonts
+in which the glyph is an outlier: where its change from the first font differs
+from that font's typical change (the median over all glyphs) by more than
+THRESHOLD times the robust spread of those changes (or by more than 1 unit,
+if larger).
 
-# from __future__ import print_function
-# from fontTools.misc.py23 import *
-from fontTools.ttLib import TTFont
-from glob import glob
+Output is CSV unless OUTFILE ends in .parquet (which needs pandas and pyarrow).
+'''
+
+from fontmetrics import readglyphmetrics, glyphMetricNames
+from fontcrawler import findfonts, crawl
+import instrument
+import argparse
 import csv
 import sys
+import warnings
+import numpy as np
+
+
+def alignmetrics(fontmetrics):
+    ''' align per-font (glyphOrder, metrics) results by glyph name
+
+    Returns (glyphs, values) where glyphs is the union of glyph names (in order
+    of first appearance) and values is a float array indexed [font, glyph, metric],
+    NaN where a font lacks the glyph.
+    '''
+    glyphs = []
+    gindex = {}
+    for glyphOrder, _ in fontmetrics:
+        for g in glyphOrder:
+            if g not in gindex:
+                gindex[g] = len(glyphs)
+                glyphs.append(g)
+    values = np.full((len(fontmetrics), len(glyphs), len(glyphMetricNames)), np.nan)
+    for i, (glyphOrder, metrics) in enumerate(fontmetrics):
+        values[i, [gindex[g] for g in glyphOrder]] = metrics
+    return glyphs, values
+
+def outliers(values, threshold):
+    ''' return boolean array [font, glyph, metric] flagging glyphs whose change from the first font is unusual for that font '''
+    deltas = values - values[0]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     # all-NaN slices
+        median = np.nanmedian(deltas, axis=1, keepdims=True)
+        spread = 1.4826 * np.nanmedian(np.abs(deltas - median), axis=1, keepdims=True)
+        return np.abs(deltas - median) > threshold * np.fmax(spread, 1)
+
 
-headfields = ('xMin','yMin','xMax', 'xMin')
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fontfiles', help='font file(s) or folders (searched recursively); can contain wildcards', nargs='+', metavar='fontfile*.ttf')
+    parser.add_argument('-j', '--jobs', help='number of fonts to read concurrently (default: %(default)s)', type=int, default=8)
+    parser.add_argument('-o', '--outfile', help='output file (default: %(default)s)', default='glyphMetrics.csv')
+    parser.add_argument('-t', '--threshold', help='outlier threshold (default: %(default)s)', type=float, default=3.5)
+    instrument.addArguments(parser)
+    args = parser.parse_args(args)
 
-if len(sys.argv) != 2:
-	print("usage: showGlyphMetrics.py fontfile*.ttf")
-	sys.exit(1)
+    with instrument.fromArgs(args, 'showGlyphMetrics'):
+        fontfiles = []
+        results = []
+        for fontfile, res, error in crawl(findfonts(args.fontfiles), readglyphmetrics, args.jobs):
+            if error:
+                print(f'unable to read "{fontfile}": {error}', file=sys.stderr)
+                continue
+            fontfiles.append(fontfile)
+            results.append(res)
+        if not fontfiles:
+            print('no font files found', file=sys.stderr)
+            return 1
 
-with open('glyphMetrics.csv', 'wb') as csvfile:
-    csvwriter = csv.writer(csvfile)
+        with instrument.phase('compare'):
+            glyphs, values = alignmetrics(results)
+            flags = outliers(values, args.threshold)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                lo = np.nanmin(values, axis=0)
+                hi = np.nanmax(values, axis=0)
 
-    fonts = []
-    header = ['','']
-    for fontfile in glob(sys.argv[1]):
-        fonts.append(TTFont(fontfile))
-        header.append(fontfile)
-    csvwriter.writerow(header)
+        # One row per glyph and metric; columns are the fonts then the summaries
+        nglyphs, nmetrics = len(glyphs), len(glyphMetricNames)
+        rowGlyphs = np.repeat(np.array(glyphs, dtype=object), nmetrics)
+        rowMetrics = np.tile(np.array(glyphMetricNames, dtype=object), nglyphs)
+        perFont = values.reshape(len(fontfiles), -1)
+        lo, hi = lo.reshape(-1), hi.reshape(-1)
+        flagged = flags.reshape(len(fontfiles), -1)
+        outlierFonts = [';'.join(fontfiles[i] for i in np.nonzero(col)[0]) for col in flagged.T]
+        header = ['glyph', 'metric'] + fontfiles + ['min', 'max', 'range', 'outliers']
 
-    def doRow(tablename,fieldname):
-        if doRow.prevtable != tablename:
-            row = [tablename,fieldname]
-            doRow.prevtable = tablename
-        else:
-            row = ['',fieldname]
-        for f in fonts:
-            row.append(f[tablename].__getattribute__(fieldname))
-        csvwriter.writerow(row)
+        if args.outfile.lower().endswith('.parquet'):
+            import pandas as pd
+            columns = {'glyph': rowGlyphs, 'metric': rowMetrics}
+            columns.update(zip(fontfiles, perFont))
+            columns.update({'min': lo, 'max': hi, 'range': hi - lo, 'outliers': outlierFonts})
+            pd.DataFrame(columns).to_parquet(args.outfile)
+            return 0
 
-    doRow.prevtable = ''
-    for tableName,fieldList in (('head', headfields),):
-        for fieldname in fieldList:
-            doRow(tableName, fieldname)
+        def fmt(column):
+            return ['' if np.isnan(v) else f'{v:g}' for v in column]
+        columns = [rowGlyphs, rowMetrics] + [fmt(c) for c in perFont] + [fmt(lo), fmt(hi), fmt(hi - lo), outlierFonts]
+        with open(args.outfile, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(header)
+            csvwriter.writerows(zip(*columns))
+        return 0
 
 
-    for f in fonts:
-        f.close()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,10 @@
 #!/usr/bin/python3
 """ print in tabular form line metrics from multiple ttf fonts"""
 
-from fontTools.ttLib import TTFont
-from glob import glob
+from fontmetrics import readfields, FieldCache
+from fontcrawler import findfonts, crawl
+import instrument
+import argparse
 import csv
 import sys
 
@@ -15,39 +17,59 @@ os2fields = ('sTypoAscender', 'sTypoDescender', 'sTypoLineGap', 'USE_TYPO_METRIC
              'yStrikeoutSize', 'yStrikeoutPosition')
 postfields = ('underlinePosition', 'underlineThickness')
 
-if len(sys.argv) < 2:
-    print("usage: showLineMetrics.py fontfile*.ttf ...")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('fontfiles', help='font file(s) or folders (searched recursively); can contain wildcards', nargs='+', metavar='fontfile*.ttf')
+parser.add_argument('-j', '--jobs', help='number of fonts to read concurrently (default: %(default)s)', type=int, default=8)
+parser.add_argument('--cache', help='cache of fields already read from unchanged fonts (default: %(default)s)', default='metrics-cache.json')
+parser.add_argument('--nocache', help="don't read or write the cache", action='store_true')
+parser.add_argument('--rebuild', help='ignore the existing cache, re-reading every font', action='store_true')
+instrument.addArguments(parser)
+args = parser.parse_args()
+
+inst = instrument.fromArgs(args, 'showLineMetrics')
+with inst:
+    tables = (('head', headfields), ('hhea', hheafields), ('OS/2', os2fields + ('fsSelection',)), ('post', postfields))
+    cache = None if args.nocache else FieldCache(args.cache, tables, args.rebuild)
+
+    with open('metrics.csv', 'w', newline='', encoding='utf-8') as csvfile:
+        csvwriter = csv.writer(csvfile)
 
-with open('metrics.csv', 'w', newline='', encoding='utf-8') as csvfile:
-    csvwriter = csv.writer(csvfile)
+        # Read just the fields we need from each font, reading several fonts concurrently
+        def extract(fontfile):
+            return readfields(fontfile, tables) if cache is None else cache.readfields(fontfile)
 
-    fonts = []
-    header = ['', '']
+        fonts = []
+        header = ['', '']
 
-    for arg in sys.argv[1:]:
-        for fontfile in glob(arg):
-            fonts.append(TTFont(fontfile))
+        for fontfile, fields, error in crawl(findfonts(args.fontfiles), extract, args.jobs):
+            if error:
+                print(f'unable to read "{fontfile}": {error}', file=sys.stderr)
+                continue
+            fonts.append(fields)
             header.append(fontfile)
-    csvwriter.writerow(header)
-
-    def doRow(tablename,fieldname):
-        if doRow.prevtable != tablename:
-            row = [tablename, fieldname]
-            doRow.prevtable = tablename
-        else:
-            row = ['', fieldname]
-        for f in fonts:
-            if fieldname == 'USE_TYPO_METRICS':
-                row.append('True' if f[tablename].fsSelection & 0x80 else 'False')
+        csvwriter.writerow(header)
+
+        def doRow(tablename,fieldname):
+            if doRow.prevtable != tablename:
+                row = [tablename, fieldname]
+                doRow.prevtable = tablename
             else:
-                row.append(f[tablename].__getattribute__(fieldname))
-        csvwriter.writerow(row)
+                row = ['', fieldname]
+            for f in fonts:
+                if fieldname == 'USE_TYPO_METRICS':
+                    row.append('True' if f[tablename]['fsSelection'] & 0x80 else 'False')
+                else:
+                    row.append(f[tablename][fieldname])
+            csvwriter.writerow(row)
+
+        doRow.prevtable = ''
+        for tableName, fieldList in (('head', headfields), ('hhea', hheafields), ('OS/2', os2fields), ('post', postfields)):
+            for fieldname in fieldList:
+                doRow(tableName, fieldname)
 
-    doRow.prevtable = ''
-    for tableName, fieldList in (('head', headfields), ('hhea', hheafields), ('OS/2', os2fields), ('post', postfields)):
-        for fieldname in fieldList:
-            doRow(tableName, fieldname)
+    if cache is not None:
+        cache.save()
 
-    for f in fonts:
-        f.close()
+if not fonts:
+    print('no font files found', file=sys.stderr)
+    sys.exit(1)
@@ -1,33 +1,91 @@
 #!/usr/bin/python3
 
 import sys
-from fontTools.ttLib import TTFont
-from glob import glob
+import mmap
+import struct
+import zlib
+import argparse
+from fontcrawler import findfonts, crawl
+import instrument
 import xml.etree.ElementTree as ET
 
+woffExtensions = ('.woff', '.woff2')
 
-def main(args=None):
-    if args is None:
-        args = sys.argv[1:]
+# Only the fields up to the metadata block's location are needed
+woffHeader = struct.Struct('>4s4sLHHLHHLLL')        # signature ... metaOffset, metaLength, metaOrigLength
+woff2Header = struct.Struct('>4s4sLHHLLHHLLL')      # as WOFF, with totalCompressedSize after totalSfntSize
+
+
+def woffMetadata(buf):
+    """ return the decompressed extended metadata XML from WOFF or WOFF2 font data, or None if there is none.
+
+    Only the header and the metadata block itself are looked at, so buf can be
+    an mmap of a large file without the font tables being read.
+    """
+    signature = bytes(buf[:4])
+    if signature == b'wOFF':
+        header = woffHeader
+    elif signature == b'wOF2':
+        header = woff2Header
+    else:
+        return None     # not a WOFF font, so no WOFF metadata
+    if len(buf) < header.size:
+        raise ValueError('truncated WOFF header')
+    metaOffset, metaLength, metaOrigLength = header.unpack_from(buf)[-3:]
+    if metaOffset == 0 or metaLength == 0:
+        return None
+    if metaOffset + metaLength > len(buf):
+        raise ValueError('metadata block extends past end of file')
+
+    block = buf[metaOffset:metaOffset + metaLength]
+    if signature == b'wOFF':
+        data = zlib.decompress(block)
+    else:
+        import brotli
+        data = brotli.decompress(block)
+    if len(data) != metaOrigLength:
+        raise ValueError('metadata length mismatch')
+    return data
 
-    if len(args) < 1:
-        print("usage: showWoffUniqueID INPUT.woff", file=sys.stderr)
-        return 1
+def readMetadata(infile):
+    """ return the WOFF/WOFF2 extended metadata of a font file (or None), reading it through mmap """
+    with open(infile, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None     # empty file
+        with buf:
+            return woffMetadata(buf)
 
-    for arg in args:
-        for infile in glob(arg):
-            font = TTFont(infile)
 
-            if not font.flavorData or not font.flavorData.metaData:
+def main(args=None):
+    parser = argparse.ArgumentParser(description='print the unique ID from the extended metadata of WOFF and WOFF2 fonts')
+    parser.add_argument('fontfiles', help='font file(s) or folders (searched recursively for .woff and .woff2 files); can contain wildcards', nargs='+', metavar='INPUT.woff')
+    parser.add_argument('-j', '--jobs', help='number of fonts to read concurrently (default: %(default)s)', type=int, default=8)
+    instrument.addArguments(parser)
+    args = parser.parse_args(args)
+
+    with instrument.fromArgs(args, 'showWoffUniqueID'):
+        found = 0
+        for infile, metaData, error in crawl(findfonts(args.fontfiles, woffExtensions), readMetadata, args.jobs):
+            found += 1
+            if error:
+                print(f"{infile}: unable to read WOFF metadata: {error}")
+                continue
+
+            if not metaData:
                 print(f"No WOFF metadata in {infile}")
             else:
-                root = ET.fromstring(font.flavorData.metaData)
+                root = ET.fromstring(metaData)
                 uniqueid = root.find('uniqueid')
-                if 'uniqueid' is not None:
+                if uniqueid is not None:
                     print(f'{infile}: {uniqueid.get("id", "Unique ID element has no ID attribute")}')
                 else:
                     print(f'{infile}: no unique ID element found')
-
+        if not found:
+            print('no font files found', file=sys.stderr)
+            return 1
+    return 0
 
 
 
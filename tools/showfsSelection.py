@@ -1,43 +1,62 @@
 #!/usr/bin/python3
 """ print in tabular form fsSelection from multiple ttf fonts"""
 
-from fontTools.ttLib import TTFont
-from glob import glob
+from fontmetrics import readfields, FieldCache
+from fontcrawler import findfonts, crawl
+import instrument
+import argparse
 import csv
 import sys
 from os.path import getmtime
 from time import strftime, localtime
 
-if len(sys.argv) < 2:
-    print("usage: showfsSelection.py fontfile*.ttf ...")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('fontfiles', help='font file(s) or folders (searched recursively); can contain wildcards', nargs='+', metavar='fontfile*.ttf')
+parser.add_argument('-j', '--jobs', help='number of fonts to read concurrently (default: %(default)s)', type=int, default=8)
+parser.add_argument('--cache', help='cache of fields already read from unchanged fonts (default: %(default)s)', default='fsSelection-cache.json')
+parser.add_argument('--nocache', help="don't read or write the cache", action='store_true')
+parser.add_argument('--rebuild', help='ignore the existing cache, re-reading every font', action='store_true')
+instrument.addArguments(parser)
+args = parser.parse_args()
+
+inst = instrument.fromArgs(args, 'showfsSelection')
+with inst:
+    tables = (('OS/2', ('version', 'fsSelection')),)
+    cache = None if args.nocache else FieldCache(args.cache, tables, args.rebuild)
+
+    with open('fsSelection.csv', 'w', newline='', encoding='utf-8') as csvfile:
+        csvwriter = csv.writer(csvfile)
 
-with open('fsSelection.csv', 'w', newline='', encoding='utf-8') as csvfile:
-    csvwriter = csv.writer(csvfile)
+        bitList = ['Italic', 'Underscore', 'Negative', 'Outlined', 'StrikeOut', 'Bold', 'Regular',
+                   'UseTypoMetrics', 'WWS', 'Oblique']
+        bitMasks = [1 << x for x in range(len(bitList))]
 
-    bitList = ['Italic', 'Underscore', 'Negative', 'Outlined', 'StrikeOut', 'Bold', 'Regular',
-               'UseTypoMetrics', 'WWS', 'Oblique']
-    bitMasks = [1 << x for x in range(len(bitList))]
+        header = ['font', 'mod year', 'OS/2 ver']
+        header.extend(bitList)
+        csvwriter.writerow(header)
 
-    header = ['font', 'mod year', 'OS/2 ver']
-    header.extend(bitList)
-    csvwriter.writerow(header)
+        def extract(fontfile):
+            return readfields(fontfile, tables) if cache is None else cache.readfields(fontfile)
 
-    for arg in sys.argv[1:]:
-        for fontfile in glob(arg):
-            try:
-                f = TTFont(fontfile)
-            except:
+        found = 0
+        for fontfile, fields, error in crawl(findfonts(args.fontfiles), extract, args.jobs):
+            found += 1
+            if error:
+                print(f'unable to read "{fontfile}": {error}', file=sys.stderr)
                 continue
             r = [fontfile, strftime('%Y', localtime(getmtime(fontfile)))]
-            try:
-                os2 = f['OS/2']
-            except KeyError:
+            if 'OS/2' not in fields:
                 r.append('no OS/2')
                 csvwriter.writerow(r)
-                f.close()
                 continue
-            r.append(os2.version)
-            r.extend(['X' if os2.fsSelection & mask else '' for mask in bitMasks])
+            os2 = fields['OS/2']
+            r.append(os2['version'])
+            r.extend(['X' if os2['fsSelection'] & mask else '' for mask in bitMasks])
             csvwriter.writerow(r)
-            f.close()
+
+    if cache is not None:
+        cache.save()
+
+if not found:
+    print('no font files found', file=sys.stderr)
+    sys.exit(1)
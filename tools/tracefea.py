@@ -4,164 +4,1398 @@
 from fontTools.ttLib import TTFont
 from fontTools.feaLib.parser import Parser
 from fontTools.feaLib import ast
+from fontTools.feaLib.lookupDebugInfo import LOOKUP_DEBUG_INFO_KEY
+import fontTools
 import argparse     #, logging, os, gc
+import atexit
+import contextlib
+import gc
+import signal
+import stat
 import sys
+import os
+import io
+import csv
+import json
 import re
+import hashlib
+import mmap
+import struct
+import pickle
+import weakref
+import bisect
+from array import array
+import time
+from concurrent.futures import ProcessPoolExecutor
+import instrument
 
 def loc(locationObject):
     """ format an object's location attribute the way we want to see it"""
     return f'line {locationObject.location.line}'
 
-def glyphMatch(glyphName, glyphObject):
-    """ return true if glyphname matches the glyphObject (single glyph, class, etc.)"""
+# frozensets of the named glyph and mark classes, shared by every rule that uses them
+_classSets = weakref.WeakKeyDictionary()
+
+def glyphSet(glyphObject):
+    """ return the frozenset of glyph names matched by the glyphObject (single glyph, class, etc.)"""
     if isinstance(glyphObject, ast.GlyphName):
-        return glyphName == glyphObject.glyph
+        return frozenset((glyphObject.glyph,))
     elif isinstance(glyphObject, ast.GlyphClassName):
-        return glyphName in glyphObject.glyphclass.glyphs.glyphs
+        glyphs = _classSets.get(glyphObject.glyphclass)
+        if glyphs is None:
+            glyphs = _classSets[glyphObject.glyphclass] = frozenset(glyphObject.glyphclass.glyphs.glyphs)
+        return glyphs
     elif isinstance(glyphObject, ast.GlyphClass):
-        return glyphName in glyphObject.glyphs
+        return frozenset(glyphObject.glyphs)
+    elif isinstance(glyphObject, ast.MarkClassName):
+        glyphs = _classSets.get(glyphObject.markClass)
+        if glyphs is None:
+            glyphs = _classSets[glyphObject.markClass] = frozenset(glyphObject.markClass.glyphs)
+        return glyphs
     else:
         raise TypeError(f'unhandled glyph object "{glyphObject.asFea()}" -- aborting.')
 
 
+# regex to find include statements (ignoring those that are commented out)
+includeRE = re.compile(r'^[^#\n]*?\binclude\s*\(\s*([^)]*?)\s*\)', re.MULTILINE)
+
+def feaDependencies(feapath):
+    """ return the paths of a fea file and of all files it includes, recursively.
+    Relative includes are resolved against the top-level file's folder, as feaLib does."""
+    includeDir = os.path.dirname(feapath)
+    deps = []
+    todo = [feapath]
+    while todo:
+        path = todo.pop()
+        if path in deps:
+            continue
+        deps.append(path)
+        try:
+            with open(path, encoding='utf-8-sig') as f:
+                text = f.read()
+        except OSError:
+            continue    # the parser will complain, if it matters
+        todo.extend(os.path.join(includeDir, m) for m in includeRE.findall(text))
+    return deps
+
+def feaCacheKey(feapath, glyphOrder=None):
+    """ return a key that changes whenever the fea file, anything it includes or the glyph order changes """
+    h = hashlib.sha256()
+    h.update(f'{fontTools.version}\0{os.path.abspath(feapath)}\0'.encode('utf-8'))
+    for path in feaDependencies(feapath):
+        h.update(path.encode('utf-8') + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            h.update(b'missing')
+    if glyphOrder is not None:
+        h.update('\0'.join(glyphOrder).encode('utf-8'))
+    return h.hexdigest()
+
+def defaultCacheDir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'tracefea')
+
+# Cached parse trees beyond this total size are removed, least recently used first
+cacheMaxBytes = 256 * 1024 * 1024
+
+@contextlib.contextmanager
+def _gcPaused():
+    """ suspend the cyclic garbage collector, which otherwise spends most of the time
+    taken to build a big parse tree (or unpickle one) scanning the new objects """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def parseFea(feapath, glyphOrder=None, cachedir=None):
+    """ parse a fea file, returning its ast.FeatureFile
+
+    If cachedir is supplied, the parse tree is pickled there and reused by later
+    calls as long as the fea file, its includes and the glyph order are unchanged.
+    Loading the pickle is about three times as fast as parsing. The cache is kept
+    under cacheMaxBytes by pruneCache().
+    """
+    glyphNames = () if glyphOrder is None else glyphOrder
+    if cachedir is None:
+        with instrument.phase('parse'), _gcPaused():
+            return Parser(feapath, glyphNames).parse()
+
+    cachefile = os.path.join(cachedir, feaCacheKey(feapath, glyphOrder) + '.pickle')
+    try:
+        with instrument.phase('read parse cache'), _gcPaused(), open(cachefile, 'rb') as f:
+            parsetree = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass    # no usable cache entry
+    else:
+        try:
+            os.utime(cachefile)     # mark as recently used for pruneCache()
+        except OSError:
+            pass
+        return parsetree
+
+    with instrument.phase('parse'), _gcPaused():
+        parsetree = Parser(feapath, glyphNames).parse()
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(parsetree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+        pruneCache(cachedir)
+    except (OSError, pickle.PicklingError, RecursionError) as e:
+        print(f'warning: unable to cache parse of "{feapath}": {e}', file=sys.stderr)
+    return parsetree
+
+def _cacheEntries(cachedir):
+    """ return (mtime, size, path) for each cached parse tree """
+    entries = []
+    try:
+        names = os.listdir(cachedir)
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        if name.endswith('.pickle'):
+            path = os.path.join(cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def pruneCache(cachedir, maxbytes=None):
+    """ remove the least recently used parse trees until the cache holds at most maxbytes
+    (default cacheMaxBytes); the newest entry is always kept """
+    maxbytes = cacheMaxBytes if maxbytes is None else maxbytes
+    entries = sorted(_cacheEntries(cachedir), reverse=True)
+    total = 0
+    for i, (mtime, size, path) in enumerate(entries):
+        total += size
+        if total > maxbytes and i > 0:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def clearCache(cachedir):
+    """ remove every cached parse tree; returns the number removed """
+    removed = 0
+    for mtime, size, path in _cacheEntries(cachedir):
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+# Kinds of compiled rule; each rule is a tuple (kind, statement, ...)
+SINGLE, PAIR, CONTEXT = range(3)
+
+class LookupIndex(object):
+    """ compiled form of a LookupBlock
+
+    Statements are indexed by the glyph they must match first, so a query only
+    visits the rules that could possibly match. Each candidate list is kept in
+    source order so masking is reported exactly as a linear scan would.
+
+    Building the index visits every glyph of every class a rule starts with, which
+    costs more than scanning the rules once, so the first query just scans them and
+    the index is built when a second one comes.
+    """
+
+    def __init__(self, lkup, compiled):
+        # compiled maps LookupBlocks to their LookupIndex; register ourselves
+        # first so lookups referenced from contextual rules can point back at us
+        compiled[lkup] = self
+        self.name = lkup.name
+        self.flags = ownFlags(lkup)
+        self.ruleList = []  # (first glyph set, rule) in source order
+        self._rules = None
+        self._scanned = False
+
+        for s in lkup.statements:
+            if isinstance(s, ast.SinglePosStatement) and not s.forceChain:
+                # Single Position statement; each (glyphs, value) pair is its own rule
+                for pos in s.pos:
+                    self._add(glyphSet(pos[0]), (SINGLE, s, pos[1]))
+
+            elif isinstance(s, ast.PairPosStatement):
+                self._add(glyphSet(s.glyphs1), (PAIR, s, glyphSet(s.glyphs2)))
+
+            elif isinstance(s, (ast.ChainContextSubstStatement, ast.ChainContextPosStatement)) or \
+                    (isinstance(s, ast.SinglePosStatement) and s.forceChain):
+                # Contextual: compiled to one glyph set per position (prefix, input, suffix)
+                prefix = [glyphSet(g) for g in s.prefix]
+                suffix = [glyphSet(g) for g in s.suffix]
+                if isinstance(s, (ast.ChainContextSubstStatement, ast.ChainContextPosStatement)):
+                    # proper chaining contextual lookup
+                    inputs = [glyphSet(g) for g in s.glyphs]
+                    lookups = [None if lkupList is None else
+                               [compiled[l] if l in compiled else LookupIndex(l, compiled) for l in lkupList]
+                               for lkupList in s.lookups]
+                else:
+                    # a single positioning lookup with forceChain set: the marked positions are the input
+                    inputs = [glyphSet(p[0]) for p in s.pos]
+                    lookups = None
+                self._add(inputs[0], (CONTEXT, s, tuple(prefix + inputs + suffix), len(prefix), lookups))
+
+    def _add(self, glyphs, rule):
+        self.ruleList.append((glyphs, rule))
+
+    @property
+    def rules(self):
+        """ dict mapping each first glyph name to its rules in source order, built when first needed """
+        if self._rules is None:
+            rules = {}
+            with _gcPaused():
+                for glyphs, rule in self.ruleList:
+                    for g in glyphs:
+                        rules.setdefault(g, []).append(rule)
+            self._rules = rules
+        return self._rules
+
+    def candidates(self, glyph):
+        """ return the rules that start with glyph, in source order """
+        if self._rules is None and not self._scanned:
+            self._scanned = True
+            return [rule for glyphs, rule in self.ruleList if glyph in glyphs]
+        return self.rules.get(glyph, ())
+
+    def matches(self, glyphs):
+        """ scan a glyph run once, yielding (offset, rule) for every rule matching at every offset """
+        for offset, g in enumerate(glyphs):
+            for rule in self.rules.get(g, ()):
+                if ruleMatch(rule, glyphs, offset):
+                    yield offset, rule
+
+
+def ruleMatch(rule, glyphs, offset):
+    """ return true if a compiled rule matches glyphs with its (first) input glyph at offset.
+    The glyph at offset is assumed to have been matched already by the index. """
+    kind = rule[0]
+    if kind == SINGLE:
+        return True
+    elif kind == PAIR:
+        return offset + 1 < len(glyphs) and glyphs[offset + 1] in rule[2]
+    else:
+        sets, start = rule[2], offset - rule[3]
+        if start < 0 or start + len(sets) > len(glyphs):
+            return False  # Can't possibly match
+        return all(map(frozenset.__contains__, sets, glyphs[start:start + len(sets)]))
+
+
+_compiledLookups = weakref.WeakKeyDictionary()
+
+def compileLookup(lkup):
+    """ return the (cached) LookupIndex for a LookupBlock """
+    index = _compiledLookups.get(lkup)
+    if index is None:
+        with _gcPaused():
+            index = LookupIndex(lkup, _compiledLookups)
+    return index
+
+
 def traceFea(lkup, glyphs, offset=0):
-    """ see if a specific lookup matches a list of glyphs at a specific offset """
+    """ see if a specific lookup matches a list of glyphs at a specific offset
+
+    lkup may be a LookupBlock, a LookupIndex returned by compileLookup() or a GposLookup
+    """
+    if isinstance(lkup, GposLookup):
+        return lkup.trace(glyphs, offset)
+    index = lkup if isinstance(lkup, LookupIndex) else compileLookup(lkup)
     res = []
-    for s in lkup.statements:
-        # print(s.asFea())
-        if isinstance(s, ast.SinglePosStatement) and not s.forceChain:
-            # Single Position statement
-            for pos in s.pos:
-                if glyphMatch(glyphs[offset], pos[0]):
-                    # yes we have a winner!
-                    masked = '# (MASKED)' if len(res) > 0 else ''
-                    res.append(f"{loc(s)} Lookup {lkup.name} SinglePos {glyphs[offset]} --> {pos[1].asFea()}  {masked}")
-                    continue
-
-        elif isinstance(s, ast.PairPosStatement):
-            # Pair Position statement
-            if glyphMatch(glyphs[offset], s.glyphs1) and glyphMatch(glyphs[offset + 1], s.glyphs2):
-                # yes we have a winner!
-                masked = '# (MASKED)' if len(res) > 0 else ''
-                res.append(f"{loc(s)} Lookup {lkup.name} PairPos {glyphs[offset]},{glyphs[offset + 1]} --> {s.asFea()}  {masked}")
+    for rule in index.candidates(glyphs[offset]):
+        if not ruleMatch(rule, glyphs, offset):
             continue
+        # yes we have a winner!
+        kind, s = rule[0], rule[1]
+        masked = '# (MASKED)' if len(res) > 0 else ''
+        if kind == SINGLE:
+            res.append(f"{loc(s)} Lookup {index.name} SinglePos {glyphs[offset]} --> {rule[2].asFea()}  {masked}")
 
-        elif isinstance(s, (ast.ChainContextSubstStatement, ast.ChainContextPosStatement)) or \
-                (isinstance(s, ast.SinglePosStatement) and s.forceChain):
-            # Contextual
-            if len(s.prefix) > 0:
-                ## TODO implement support for prefix strings
-                raise NotImplementedError
-            if len(s.prefix) > offset or offset + (1 if not hasattr(s,'glyphs') else len(s.glyphs)) + len(s.suffix) > len(glyphs):
-                continue  # Can't possibly match
-            mismatch = False  # assume success
-            if isinstance(s, (ast.ChainContextSubstStatement, ast.ChainContextPosStatement)):
-                # proper chaining contextual lookup
-                for i, g in enumerate(s.glyphs):
-                    if not glyphMatch(glyphs[offset+i], g):
-                        mismatch = True
-                        break
-                for i, g in enumerate(s.suffix):
-                    if not glyphMatch(glyphs[offset + len(s.glyphs) + i], g):
-                        mismatch = True
-                        break
-            else:
-                # a single positioning lookup with forceChain set
-                for i, p in enumerate(s.pos):
-                    # I'm only guessing how this works
-                    if glyphMatch(glyphs[offset], p[0]):
-                        break
-                    else:
-                        mismatch = True
-                for i, g in enumerate(s.suffix):
-                    if not glyphMatch(glyphs[offset + 1 + i], g):
-                        mismatch = True
-                        break
-            if mismatch:
-                continue
+        elif kind == PAIR:
+            res.append(f"{loc(s)} Lookup {index.name} PairPos {glyphs[offset]},{glyphs[offset + 1]} --> {s.asFea()}  {masked}")
+
+        else:
             # We have a context match!
-            masked = '# (MASKED)' if len(res) > 0 else ''
-            res.append(f"{loc(s)} Lookup {lkup.name} Context match --> {s.asFea()}  {masked}")
+            res.append(f"{loc(s)} Lookup {index.name} Context match --> {s.asFea()}  {masked}")
 
             # If this is the first matching context, do all the actions:
-            if isinstance(s, (ast.ChainContextSubstStatement, ast.ChainContextPosStatement)) and len(res) == 1:
-                for i,lkupList in enumerate(s.lookups):
+            lookups = rule[4]
+            if lookups is not None and len(res) == 1:
+                for i, lkupList in enumerate(lookups):
                     if lkupList != None:
                         for l in lkupList:
-                            res2 = traceFea(l, glyphs, offset+i)
-                            res.extend(res2)
+                            # a nested lookup sees the glyphs through its own lookupflag
+                            target = glyphs.nested(l, offset+i) if isinstance(glyphs, GlyphView) else (glyphs, offset+i)
+                            if target is not None:
+                                res2 = traceFea(l, *target)
+                                res.extend(res2)
+
+    return(res)
+
+def traceRun(lkup, glyphs):
+    """ trace a lookup at every offset of a glyph run, yielding (offset, results) where something matched """
+    index = lkup if isinstance(lkup, (LookupIndex, GposLookup)) else compileLookup(lkup)
+    offsets = sorted({offset for offset, rule in index.matches(glyphs)})
+    for offset in offsets:
+        yield offset, traceFea(index, glyphs, offset)
+
+
+# Lookup flag bits (as in the OpenType LookupFlag field)
+RIGHT_TO_LEFT, IGNORE_BASE_GLYPHS, IGNORE_LIGATURES, IGNORE_MARKS = 0x1, 0x2, 0x4, 0x8
+
+# Rule statements that feaLib gathers into lookups when they are placed directly in a feature block
+ruleStatements = (ast.SinglePosStatement, ast.PairPosStatement, ast.CursivePosStatement,
+                  ast.MarkBasePosStatement, ast.MarkLigPosStatement, ast.MarkMarkPosStatement,
+                  ast.ChainContextPosStatement, ast.ChainContextSubstStatement,
+                  ast.SingleSubstStatement, ast.MultipleSubstStatement, ast.AlternateSubstStatement,
+                  ast.LigatureSubstStatement, ast.ReverseChainSingleSubstStatement)
+
+def ownFlags(lkup):
+    """ return the LookupFlagStatement in effect for the first rule of a LookupBlock, or None """
+    flags = None
+    for s in lkup.statements:
+        if isinstance(s, ast.LookupFlagStatement):
+            flags = s
+        elif isinstance(s, ruleStatements):
+            break
+    return flags
+
+class GlyphClasses(object):
+    """ GDEF glyph classes (1 base, 2 ligature, 3 mark, 4 component), used to work out
+    which glyphs a lookupflag skips """
+
+    def __init__(self, classDefs):
+        self.classDefs = classDefs      # glyph name -> class
+        self._ignored = {}
+
+    @classmethod
+    def fromFea(cls, parsetree, font=None):
+        """ glyph classes from the fea GDEF table block if it has a GlyphClassDef, else from
+        the font's GDEF (if any), else inferred from the markClass definitions as feaLib does """
+        for s in parsetree.statements:
+            if isinstance(s, ast.TableBlock) and s.name == 'GDEF':
+                for d in s.statements:
+                    if isinstance(d, ast.GlyphClassDefStatement):
+                        classDefs = {}
+                        for c, glyphs in enumerate((d.baseGlyphs, d.ligatureGlyphs, d.markGlyphs, d.componentGlyphs), 1):
+                            if glyphs is not None:
+                                classDefs.update(dict.fromkeys(glyphSet(glyphs), c))
+                        return cls(classDefs)
+        if font is not None and 'GDEF' in font and font['GDEF'].table.GlyphClassDef is not None:
+            return cls.fromFont(font)
+        return cls({g: 3 for s in parsetree.statements if isinstance(s, ast.MarkClassDefinition)
+                         for g in glyphSet(s.glyphs)})
+
+    @classmethod
+    def fromFont(cls, font):
+        """ glyph classes from the font's GDEF, if any """
+        if 'GDEF' in font and font['GDEF'].table.GlyphClassDef is not None:
+            return cls(dict(font['GDEF'].table.GlyphClassDef.classDefs))
+        return cls({})
+
+    def ignored(self, flags):
+        """ return the frozenset of glyphs skipped by a LookupFlagStatement (or None) """
+        if flags is None:
+            return frozenset()
+        key = id(flags)
+        if key not in self._ignored:
+            skip = {cls for bit, cls in ((IGNORE_BASE_GLYPHS, 1), (IGNORE_LIGATURES, 2), (IGNORE_MARKS, 3)) if flags.value & bit}
+            attach = None if flags.markAttachment is None else glyphSet(flags.markAttachment)
+            filterSet = None if flags.markFilteringSet is None else glyphSet(flags.markFilteringSet)
+            self._ignored[key] = frozenset(g for g, cls in self.classDefs.items() if cls in skip or
+                                           (cls == 3 and attach is not None and g not in attach) or
+                                           (cls == 3 and filterSet is not None and g not in filterSet))
+        return self._ignored[key]
+
+class GlyphView(object):
+    """ a read-only view of a glyph sequence that skips the glyphs a lookup ignores
+
+    positions maps offsets in the view to offsets in the underlying sequence, which is not copied.
+    """
+    __slots__ = ('base', 'classes', 'positions')
+
+    def __init__(self, base, classes, flags):
+        self.base = base
+        self.classes = classes
+        ignore = classes.ignored(flags)
+        self.positions = [i for i, g in enumerate(base) if g not in ignore] if ignore else range(len(base))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.base[p] for p in self.positions[i]]
+        return self.base[self.positions[i]]
+
+    def __iter__(self):
+        return (self.base[p] for p in self.positions)
+
+    def nested(self, lkup, offset):
+        """ return (view, offset) for applying lookup lkup at our offset, or None if lkup skips that glyph """
+        index = lkup if isinstance(lkup, LookupIndex) else compileLookup(lkup)
+        view = GlyphView(self.base, self.classes, index.flags)
+        position = self.positions[offset]
+        i = bisect.bisect_left(view.positions, position)
+        return (view, i) if i < len(view) and view.positions[i] == position else None
+
+
+def featureLookups(parsetree, tag):
+    """ return the lookups applied by a feature, in order, as (LookupBlock, LookupFlagStatement or None)
+
+    Rules placed directly in the feature are gathered into anonymous lookups named tag-1, tag-2, ...
+    and lookupflag statements carry over to later lookups in the feature, as in feaLib.
+    """
+    result, seen = [], set()
+    def add(lkup, flags):
+        if id(lkup) not in seen:
+            seen.add(id(lkup))
+            result.append((lkup, flags))
+
+    anonymous = 0
+    for block in parsetree.statements:
+        if not (isinstance(block, ast.FeatureBlock) and block.name == tag):
             continue
+        flags = None
+        loose = None    # anonymous lookup collecting loose rules
+        for s in block.statements:
+            if isinstance(s, ast.LookupFlagStatement):
+                flags, loose = s, None
+            elif isinstance(s, ast.LookupBlock):
+                own = [f for f in s.statements if isinstance(f, ast.LookupFlagStatement)]
+                add(s, ownFlags(s) or flags)
+                if own:
+                    flags = own[-1]
+                loose = None
+            elif isinstance(s, ast.LookupReferenceStatement):
+                add(s.lookup, ownFlags(s.lookup))
+                loose = None
+            elif isinstance(s, ruleStatements):
+                if loose is None or type(loose.statements[-1]) is not type(s):
+                    anonymous += 1
+                    loose = ast.LookupBlock(f'{tag}-{anonymous}', location=s.location)
+                    if flags is not None:
+                        loose.statements.append(flags)
+                    add(loose, flags)
+                loose.statements.append(s)
+    return result
+
+class FeatureIndex(object):
+    """ the compiled lookups of a feature, with the glyphs each one skips """
+
+    def __init__(self, parsetree, tag, font=None):
+        self.tag = tag
+        self.classes = GlyphClasses.fromFea(parsetree, font)
+        # keep the anonymous LookupBlocks alive, as compiled lookups are cached weakly
+        self.blocks = featureLookups(parsetree, tag)
+        self.lookups = [(compileLookup(lkup), flags) for lkup, flags in self.blocks]
+
+def traceFeature(feature, glyphs):
+    """ trace every lookup of a compiled feature, in order, at every offset of the glyph run.
+
+    Returns one dict per lookup with its name, lookupflag, match count (rules matched,
+    masked or not), elapsed seconds and trace, a list of (offset, results). Glyphs a lookup's
+    flags skip are stepped over. Substitutions are reported but not applied, so later lookups
+    see the original glyphs.
+    """
+    stats = []
+    for index, flags in feature.lookups:
+        start = time.perf_counter()
+        view = GlyphView(glyphs, feature.classes, flags)
+        hits = {}
+        for offset, rule in index.matches(view):
+            hits[offset] = hits.get(offset, 0) + 1
+        trace = [(view.positions[offset], traceFea(index, view, offset)) for offset in sorted(hits)]
+        stats.append({'lookup': index.name, 'flags': flags.asFea() if flags is not None else '',
+                      'matches': sum(hits.values()), 'seconds': time.perf_counter() - start, 'trace': trace})
+    return stats
+
+def findLookup(parsetree, name):
+    """ return the LookupBlock called name in a parse tree.
+    Raises KeyError if there is none and ValueError if there is more than one. """
+    lookups = [s for s in parsetree.statements if isinstance(s, ast.LookupBlock) and s.name == name]
+    if len(lookups) == 0:
+        raise KeyError(name)
+    if len(lookups) > 1:
+        raise ValueError(name)
+    return lookups[0]
+
+def loadFea(feapath, font=None, cachedir=None):
+    """ parse a fea file for use with a font, which may be a path or an open TTFont
+    (e.g. from fontpool.FontPool.get()); returns (parse tree, TTFont or None) """
+    if isinstance(font, str):
+        with instrument.phase('load font'):
+            font = TTFont(font, lazy=True)
+    return parseFea(feapath, None if font is None else font.getGlyphOrder(), cachedir), font
+
+def loadLookup(feapath, name='mainkern', font=None, cachedir=None):
+    """ library entry point: return the compiled lookup called name from a fea file, ready for
+    traceFea(), traceRun() and tracePairs(); font is as for loadFea() """
+    parsetree, font = loadFea(feapath, font, cachedir)
+    return compileLookup(findLookup(parsetree, name))
+
+def loadFeature(feapath, tag, font=None, cachedir=None):
+    """ library entry point: return the compiled lookups of a feature from a fea file, ready for
+    traceFeature(); font is as for loadFea() """
+    parsetree, font = loadFea(feapath, font, cachedir)
+    return FeatureIndex(parsetree, tag, font)
+
+def valueFea(valueRecord):
+    return '<NULL>' if valueRecord is None else valueRecord.asFea()
+
+def resolve(lkup, glyphs, offset=0):
+    """ return what a lookup does to glyphs at offset: the winning rule, and the rules of any
+    lookups it calls, as a list of (value, feaLib location) pairs. Empty if nothing matched.
+    Contextual substitutions have no value of their own. """
+    index = lkup if isinstance(lkup, LookupIndex) else compileLookup(lkup)
+    for rule in index.candidates(glyphs[offset]):
+        if not ruleMatch(rule, glyphs, offset):
+            continue
+        kind, s = rule[0], rule[1]
+        if kind == SINGLE:
+            return [(valueFea(rule[2]), s.location)]
+        elif kind == PAIR:
+            values = [s.valuerecord1] if s.valuerecord2 is None else [s.valuerecord1, s.valuerecord2]
+            return [(' '.join(valueFea(v) for v in values), s.location)]
+        elif rule[4] is None:
+            # forceChain single positioning: the values are in the rule itself
+            return [(' '.join(valueFea(p[1]) for p in s.pos), s.location)]
+        res = [('', s.location)]
+        for i, lkupList in enumerate(rule[4]):
+            if lkupList is not None:
+                for l in lkupList:
+                    target = glyphs.nested(l, offset+i) if isinstance(glyphs, GlyphView) else (glyphs, offset+i)
+                    if target is not None:
+                        res.extend(resolve(l, *target))
+        return res
+    return []
+
+def resolveRecord(lookup, glyphs, allpairs=False, alloffsets=False):
+    """ resolve one glyph sequence as traceRecord() would trace it, returning a dict mapping
+    each place something matched to its resolve() results. Places are glyph offsets, or
+    (glyph, glyph) pairs with allpairs. With a FeatureIndex, the results of all its lookups
+    at an offset are concatenated in lookup order. """
+    res = {}
+    if isinstance(lookup, FeatureIndex):
+        for index, flags in lookup.lookups:
+            view = GlyphView(glyphs, lookup.classes, flags)
+            for offset in sorted({offset for offset, rule in index.matches(view)}):
+                res.setdefault(view.positions[offset], []).extend(resolve(index, view, offset))
+    elif allpairs:
+        for g1 in glyphs:
+            for g2 in glyphs:
+                found = resolve(lookup, (g1, g2))
+                if found:
+                    res[(g1, g2)] = found
+    else:
+        for offset in (sorted({offset for offset, rule in lookup.matches(glyphs)}) if alloffsets else (0,)):
+            found = resolve(lookup, glyphs, offset)
+            if found:
+                res[offset] = found
+    return res
+
+def relLoc(location, feapath):
+    """ format a location as 'line N' in feapath itself, else as file:line relative to feapath's folder,
+    so the same rule in different fea files is reported in the same way """
+    if os.path.abspath(location.file) == os.path.abspath(feapath):
+        return f'line {location.line}'
+    return f'{os.path.relpath(location.file, os.path.dirname(os.path.abspath(feapath)))}:{location.line}'
+
+def _compareJob(feapath, fontpath, cachedir, name, tag, sequences, allpairs, alloffsets, stats):
+    """ process pool worker: parse one fea file and resolve every glyph sequence against it.
+    Returns (list of resolveRecord() results with relLoc() locations, instrumentation stats or None) """
+    with instrument.Instrument(collect=stats) as inst:
+        if tag:
+            lookup = loadFeature(feapath, tag, fontpath, cachedir)
+            if len(lookup.lookups) == 0:
+                raise KeyError(f'no lookups found for feature "{tag}"')
+        else:
+            lookup = loadLookup(feapath, name, fontpath, cachedir)
+        with instrument.phase('trace'):
+            results = [{place: [(value, relLoc(where, feapath)) for value, where in found]
+                        for place, found in resolveRecord(lookup, glyphs, allpairs, alloffsets).items()}
+                       for glyphs in sequences]
+    return results, inst.stats() if stats else None
+
+def compareFeas(targets, sequences, name='mainkern', tag=None, cachedir=None, allpairs=False, alloffsets=False, jobs=None, inst=None):
+    """ resolve glyph sequences against several (fea file, font file or None) targets, each parsed
+    in its own worker process. Returns one entry per target: the list of resolveRecord() results
+    for the sequences, or the exception that target raised. The workers' stats are merged into
+    inst, if it is a collecting Instrument. """
+    collecting = inst is not None and inst.collecting
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(targets))) as executor:
+        futures = [executor.submit(_compareJob, feapath, fontpath, cachedir, name, tag, sequences, allpairs, alloffsets, collecting)
+                   for feapath, fontpath in targets]
+        results = []
+        for future in futures:
+            try:
+                res, stats = future.result()
+            except Exception as e:
+                res, stats = e, None
+            if stats is not None:
+                inst.merge(stats)
+            results.append(res)
+    return results
+
+def printComparison(labels, sequences, results, outfile=sys.stdout):
+    """ print compareFeas() results side by side, one row for each place something matched in
+    any target. Rows are flagged * where the values differ and ~ where only the locations do.
+    Returns the number of flagged rows. """
+    def cell(found):
+        return ' > '.join(f'{value} @ {where}' if value else f'@ {where}' for value, where in found) if found else '-'
+
+    rows = [[' ', '', *labels]]
+    differ = 0
+    for seqno, glyphs in enumerate(sequences):
+        rows.append(None)
+        rows.append([' ', ','.join(glyphs)] + [''] * len(labels))
+        records = [None if isinstance(r, Exception) else r[seqno] for r in results]
+        places = set().union(*(r for r in records if r is not None))
+        for place in sorted(places, key=lambda p: (isinstance(p, tuple), p)):
+            cells = [None if r is None else r.get(place) for r in records]
+            ok = [c for r, c in zip(records, cells) if r is not None]
+            values = {tuple(v for v, w in c) if c else None for c in ok}
+            wheres = {tuple(w for v, w in c) if c else None for c in ok}
+            flag = '*' if len(values) > 1 else '~' if len(wheres) > 1 else ' '
+            differ += flag != ' '
+            name = ','.join(place) if isinstance(place, tuple) else f'{place} {glyphs[place]}'
+            rows.append([flag, name] + ['error' if r is None else cell(c) for r, c in zip(records, cells)])
+
+    widths = [max(len(row[i]) for row in rows if row is not None) for i in range(len(rows[0]))]
+    for row in rows:
+        print('' if row is None else '  '.join(f'{t:{w}}' for t, w in zip(row, widths)).rstrip(), file=outfile)
+    for label, r in zip(labels, results):
+        if isinstance(r, Exception):
+            print(f'{label}: {type(r).__name__}: {r}', file=outfile)
+    return differ
+
+# Tracing from a compiled GPOS table
 
+def valueRecordFea(valueRecord):
+    """ format a compiled ValueRecord as fea code would (device tables are left out) """
+    if valueRecord is None:
+        return '<NULL>'
+    values = [getattr(valueRecord, name, None) or 0 for name in ('XPlacement', 'YPlacement', 'XAdvance', 'YAdvance')]
+    if values[0] == values[1] == values[3] == 0:
+        return str(values[2])
+    return '<{} {} {} {}>'.format(*values)
+
+def coverageArray(coverage, gids, numGlyphs):
+    """ return an array mapping each glyph ID to its index in a Coverage table, or -1 """
+    res = array('i', [-1]) * numGlyphs
+    for i, g in enumerate(coverage.glyphs):
+        res[gids[g]] = i
+    return res
+
+def classDefArray(classDef, gids, numGlyphs):
+    """ return an array mapping each glyph ID to its class in a ClassDef table (which may be None) """
+    res = array('H', [0]) * numGlyphs
+    if classDef is not None:
+        for g, c in classDef.classDefs.items():
+            res[gids[g]] = c
+    return res
+
+
+class GposLookup(object):
+    """ a lookup from a compiled GPOS table, traced like a LookupIndex
+
+    Single and pair positioning subtables (including those in extension subtables) are
+    traced; unsupported holds the types of any other subtables, which are skipped.
+    Coverage and ClassDef tables are turned into arrays indexed by glyph ID, and the
+    pairs of a PairPos format 1 PairSet into a dict when the PairSet is first needed.
+    """
+
+    def __init__(self, gpos, index):
+        lookup = gpos.table.LookupList.Lookup[index]
+        self.index = index
+        self.name, self.location = gpos.debug.get(index, (f'lookup{index}', None))
+        self.flags = gpos.lookupFlags(lookup)
+        self.gids = gpos.gids
+        self.subtables = []     # (lookup type, subtable, coverage array, pair sets or class arrays)
+        self.unsupported = set()
+        for st in lookup.SubTable:
+            kind = lookup.LookupType
+            if kind == 9:
+                kind, st = st.ExtensionLookupType, st.ExtSubTable
+            if kind not in (1, 2):
+                self.unsupported.add(kind)
+                continue
+            coverage = coverageArray(st.Coverage, gpos.gids, gpos.numGlyphs)
+            if kind == 2 and st.Format == 1:
+                extra = [None] * len(st.PairSet)
+            elif kind == 2 and st.Format == 2:
+                extra = (classDefArray(st.ClassDef1, gpos.gids, gpos.numGlyphs), classDefArray(st.ClassDef2, gpos.gids, gpos.numGlyphs))
+            else:
+                extra = None
+            self.subtables.append((kind, st, coverage, extra))
+
+    def _value(self, subtable, glyphs, offset):
+        """ return the value(s) a subtable gives glyphs at offset, formatted as fea, or None if it doesn't match """
+        kind, st, coverage, extra = subtable
+        gid = self.gids.get(glyphs[offset])
+        if gid is None or coverage[gid] < 0:
+            return None
+        i = coverage[gid]
+        if kind == 1:
+            return valueRecordFea(st.Value if st.Format == 1 else st.Value[i])
+        if offset + 1 >= len(glyphs):
+            return None
+        gid2 = self.gids.get(glyphs[offset + 1])
+        if gid2 is None:
+            return None
+        if st.Format == 1:
+            if extra[i] is None:
+                extra[i] = {self.gids[r.SecondGlyph]: r for r in st.PairSet[i].PairValueRecord}
+            record = extra[i].get(gid2)
         else:
-            # print(f'Line {s.location.line} is of unimplemented statement type {type(s)}')
+            class1, class2 = extra[0][gid], extra[1][gid2]
+            if class1 >= st.Class1Count or class2 >= st.Class2Count:
+                return None
+            record = st.Class1Record[class1].Class2Record[class2]
+        if record is None:
+            return None
+        value1, value2 = getattr(record, 'Value1', None), getattr(record, 'Value2', None)
+        return valueRecordFea(value1) if value2 is None else f'{valueRecordFea(value1)} {valueRecordFea(value2)}'
+
+    def matches(self, glyphs):
+        """ scan a glyph run once, yielding (offset, subtable index) for every subtable matching at every offset """
+        for offset in range(len(glyphs)):
+            for j, subtable in enumerate(self.subtables):
+                if self._value(subtable, glyphs, offset) is not None:
+                    yield offset, j
+
+    def trace(self, glyphs, offset=0):
+        """ as traceFea(): describe each subtable matching glyphs at offset; all but the first are masked """
+        res = []
+        where = self.location or f'lookup {self.index}'
+        for j, subtable in enumerate(self.subtables):
+            value = self._value(subtable, glyphs, offset)
+            if value is None:
+                continue
+            masked = '# (MASKED)' if len(res) > 0 else ''
+            kind, st = subtable[:2]
+            if kind == 1:
+                res.append(f"{where} Lookup {self.name} subtable {j} SinglePos format {st.Format} {glyphs[offset]} --> {value}  {masked}")
+            else:
+                res.append(f"{where} Lookup {self.name} subtable {j} PairPos format {st.Format} {glyphs[offset]},{glyphs[offset + 1]} --> {value}  {masked}")
+        return res
+
+
+class GposIndex(object):
+    """ the GPOS table of a font, for tracing without fea source
+
+    Lookups are compiled when first used, and the font should be loaded lazily so only
+    their subtables are decompiled. If the font has the Debg table feaLib writes when
+    debugging is on (e.g. with FONTTOOLS_LOOKUP_DEBUGGING=1), lookups are named and
+    located as in the fea source.
+    """
+
+    def __init__(self, font):
+        if 'GPOS' not in font:
+            raise KeyError('GPOS')
+        self.font = font
+        self.table = font['GPOS'].table
+        self.gids = font.getReverseGlyphMap()
+        self.numGlyphs = len(font.getGlyphOrder())
+        self.classes = GlyphClasses.fromFont(font)
+        debug = font['Debg'].data.get(LOOKUP_DEBUG_INFO_KEY, {}).get('GPOS', {}) if 'Debg' in font else {}
+        self.debug = {int(i): (info[1] or f'lookup{i}', info[0]) for i, info in debug.items()}
+        self._lookups = {}
+
+    def lookup(self, index):
+        """ return the GposLookup for a lookup index """
+        if index not in self._lookups:
+            self._lookups[index] = GposLookup(self, index)
+        return self._lookups[index]
+
+    def findLookup(self, name):
+        """ return the GposLookup called name in the Debg table, or with index name.
+        Raises KeyError if there is none and ValueError if there is more than one. """
+        if name.isdigit() and int(name) < self.table.LookupList.LookupCount:
+            return self.lookup(int(name))
+        indices = [i for i, (lname, location) in self.debug.items() if lname == name]
+        if len(indices) == 0:
+            raise KeyError(name)
+        if len(indices) > 1:
+            raise ValueError(name)
+        return self.lookup(indices[0])
+
+    def lookupFlags(self, lookup):
+        """ return a compiled lookup's LookupFlag as a LookupFlagStatement, or None if it is 0 """
+        flag = lookup.LookupFlag
+        if not flag:
+            return None
+        gdef = self.font['GDEF'].table if 'GDEF' in self.font else None
+        markAttachment = markFilteringSet = None
+        if flag & 0xFF00 and gdef is not None and gdef.MarkAttachClassDef is not None:
+            markAttachment = ast.GlyphClass(sorted(g for g, c in gdef.MarkAttachClassDef.classDefs.items() if c == flag >> 8))
+        if flag & 0x10 and gdef is not None and getattr(gdef, 'MarkGlyphSetsDef', None) is not None:
+            markFilteringSet = ast.GlyphClass(list(gdef.MarkGlyphSetsDef.Coverage[lookup.MarkFilteringSet].glyphs))
+        return ast.LookupFlagStatement(flag & 0xF, markAttachment=markAttachment, markFilteringSet=markFilteringSet)
+
+    def feature(self, tag):
+        """ return the lookups of a feature as a GposFeature """
+        return GposFeature(self, tag)
+
+
+class GposFeature(FeatureIndex):
+    """ the lookups of a feature in a compiled GPOS table, for traceFeature(). The lookups of
+    all the feature's records (for every script and language) are applied in lookup order. """
+
+    def __init__(self, gpos, tag):
+        self.tag = tag
+        self.classes = gpos.classes
+        indices = sorted({i for r in gpos.table.FeatureList.FeatureRecord if r.FeatureTag == tag for i in r.Feature.LookupListIndex})
+        self.lookups = [(l, l.flags) for l in map(gpos.lookup, indices)]
+
+# regexes to extract glyph names and kern value from rawKern data
+gnameRE = re.compile(r'\[([^]]+)\]')
+kernRE = re.compile(r'{([^}]+)}')
+
+class RawKernIndex(object):
+    """ sorted index of a raw grkern2fea data file, mapping glyph sequences to the lines holding them
+
+    With indexdir, the index is kept there in a file named from the data file's
+    real path, and rebuilt whenever the data file's size or modification time
+    changes; otherwise (or if the data file isn't a regular file) it is built in
+    memory each time. It holds a header followed by fixed-size (hash, offset, lineno)
+    entries sorted by hash, and is searched by bisection through mmap.
+    The data file stays open until close(); RawKernIndex is also a context manager.
+    """
+    magic = b'TFKI0001'
+    headerFormat = struct.Struct('<8sQqQ')     # magic, data file size, data file mtime_ns, entry count
+    entryFormat = struct.Struct('<QQQ')       # hash of glyph sequence, byte offset, line number
+
+    def __init__(self, kernfile, indexdir=None):
+        self.kernfile = kernfile
+        self.fd = os.open(kernfile, os.O_RDONLY)
+        try:
+            st = os.fstat(self.fd)
+            self.idxfile = None
+            if indexdir is not None and stat.S_ISREG(st.st_mode):
+                key = hashlib.sha256(os.path.realpath(kernfile).encode('utf-8')).hexdigest()
+                self.idxfile = os.path.join(indexdir, key + '.idx')
+            self.buf = self._open(st)
+            if self.buf is None:
+                self.buf = self._build(st)
+        except:
+            os.close(self.fd)
+            raise
+        self.count = self.headerFormat.unpack_from(self.buf)[3]
+
+    def close(self):
+        """ close the data file and the index """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            if isinstance(self.buf, mmap.mmap):
+                self.buf.close()
+            self.buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def keyHash(glyphs):
+        return int.from_bytes(hashlib.blake2b('\0'.join(glyphs).encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def _open(self, st):
+        """ return mmap of existing stored index, or None if there is no valid one """
+        if self.idxfile is None:
+            return None
+        try:
+            with open(self.idxfile, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buf) >= self.headerFormat.size:
+            magic, size, mtime, count = self.headerFormat.unpack_from(buf)
+            if magic == self.magic and size == st.st_size and mtime == st.st_mtime_ns and \
+                    len(buf) == self.headerFormat.size + count * self.entryFormat.size:
+                return buf
+        buf.close()
+        return None
+
+    def _build(self, st):
+        """ scan the data file once, returning the index data (and storing it if possible) """
+        entries = []
+        offset = 0
+        with open(self.fd, 'rb', closefd=False) as f:
+            for lineno, line in enumerate(f):
+                dataGlyphs = gnameRE.findall(line.decode('utf-8'))
+                if dataGlyphs:
+                    entries.append((self.keyHash(dataGlyphs), offset, lineno))
+                offset += len(line)
+        entries.sort()
+        data = bytearray(self.headerFormat.pack(self.magic, st.st_size, st.st_mtime_ns, len(entries)))
+        for entry in entries:
+            data += self.entryFormat.pack(*entry)
+        if self.idxfile is None:
+            return bytes(data)
+        try:
+            os.makedirs(os.path.dirname(self.idxfile), exist_ok=True)
+            tmpfile = f'{self.idxfile}.{os.getpid()}.tmp'
+            with open(tmpfile, 'wb') as f:
+                f.write(data)
+            os.replace(tmpfile, self.idxfile)
+        except OSError as e:
+            print(f'warning: unable to write kern index "{self.idxfile}": {e}', file=sys.stderr)
+        return bytes(data)
+
+    def _entry(self, i):
+        return self.entryFormat.unpack_from(self.buf, self.headerFormat.size + i * self.entryFormat.size)
+
+    def _line(self, offset):
+        """ read the line starting at offset in the data file """
+        chunks = []
+        while True:
+            chunk = os.pread(self.fd, 4096, offset)
+            end = chunk.find(b'\n')
+            if end >= 0 or not chunk:
+                chunks.append(chunk[:end + 1] if end >= 0 else chunk)
+                return b''.join(chunks).decode('utf-8')
+            chunks.append(chunk)
+            offset += len(chunk)
+
+    def find(self, glyphs):
+        """ yield (lineno, line, kerns) for each record of glyphs, in file order """
+        h = self.keyHash(glyphs)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.count:
+            entryHash, offset, lineno = self._entry(lo)
+            if entryHash != h:
+                break
+            line = self._line(offset)
+            if gnameRE.findall(line) == glyphs:     # guard against hash collisions
+                yield lineno, line, kernRE.findall(line)
+            lo += 1
+
+
+def tracePairs(lookup, glyphs):
+    """ trace all pairs from glyphs, yielding ((g1, g2), results) for each pair that matched something """
+    for g1 in glyphs:
+        for g2 in glyphs:
+            res = traceFea(lookup, (g1, g2))
+            if len(res):
+                yield (g1, g2), res
+
+def traceRecord(lookup, glyphs, allpairs=False, rawkern=None, alloffsets=False):
+    """ trace one glyph sequence, returning the results as a JSON-serializable dict.
+    With a RawKernIndex, the raw kern value is included. """
+    record = {'glyphs': glyphs}
+    try:
+        with instrument.phase('trace'):
+            if rawkern is not None:
+                record['rawkern'] = None
+                for lineno, line, kerns in rawkern.find(glyphs):
+                    if len(kerns) == 1:
+                        record['rawkern'] = {'line': lineno, 'value': kerns[0]}
+                        break
+            if isinstance(lookup, FeatureIndex):
+                record['lookups'] = [dict(stats, trace=[{'offset': offset, 'trace': res} for offset, res in stats['trace']])
+                                     for stats in traceFeature(lookup, glyphs)]
+            elif allpairs:
+                record['pairs'] = [{'glyphs': list(pair), 'trace': res} for pair, res in tracePairs(lookup, glyphs)]
+            elif alloffsets:
+                record['offsets'] = [{'offset': offset, 'trace': res} for offset, res in traceRun(lookup, glyphs)]
+            else:
+                record['trace'] = traceFea(lookup, glyphs)
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+    return record
+
+def traceLines(lookup, infile, outfile, allpairs=False, rawkern=None, alloffsets=False):
+    """ trace each comma-separated glyph sequence read from infile, writing JSON Lines to outfile.
+    Blank lines and lines starting with # are skipped."""
+    for line in infile:
+        line = line.strip()
+        if not line or line.startswith('#'):
             continue
+        record = traceRecord(lookup, line.split(','), allpairs, rawkern, alloffsets)
+        outfile.write(json.dumps(record) + '\n')
+        outfile.flush()
 
-        # print(f"Lookup {lkup.name} did not match at offset {offset}")
+def serve(lookup, socketpath, allpairs=False, rawkern=None, alloffsets=False):
+    """ answer trace requests on a Unix socket until interrupted.
+    Each connection sends glyph sequences one per line and gets one JSON line back per sequence."""
+    import socketserver
+
+    class TraceHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            infile = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            outfile = io.TextIOWrapper(self.wfile, encoding='utf-8')
+            traceLines(lookup, infile, outfile, allpairs, rawkern, alloffsets)
+
+    removeStaleSocket(socketpath)
+    with socketserver.ThreadingUnixStreamServer(socketpath, TraceHandler) as server:
+        print(f'serving traces on {socketpath}', file=sys.stderr)
+        # stop (and remove the socket) on SIGTERM as on Ctrl-C
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            os.remove(socketpath)
+
+def removeStaleSocket(socketpath):
+    """ remove a socket left at socketpath by a server that is no longer running.
+    Raises FileExistsError if socketpath is something else or a server is answering on it. """
+    import socket
+    try:
+        st = os.lstat(socketpath)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(f'"{socketpath}" exists and is not a socket')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socketpath)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass    # nobody listening: stale
+        else:
+            raise FileExistsError(f'a server is already running on "{socketpath}"')
+    os.remove(socketpath)
+
+
+def kernMatrix(lkup, glyphOrder):
+    """ resolve a PairPos or SinglePos lookup over a set of glyphs using NumPy
+
+    Returns a float32 array of the xAdvance of the first value record of the
+    winning (first matching) rule: a 2D matrix indexed [first, second] for a
+    PairPos lookup or a 1D vector for a SinglePos lookup. Glyphs (or pairs) that
+    no rule matches are NaN. Contextual statements are ignored.
+    """
+    import numpy as np
+
+    gindex = {g: i for i, g in enumerate(glyphOrder)}
+    def indices(glyphObject):
+        return np.fromiter((gindex[g] for g in glyphSet(glyphObject) if g in gindex), dtype=np.intp)
+    def xAdvance(valueRecord):
+        return np.nan if valueRecord is None or valueRecord.xAdvance is None else valueRecord.xAdvance
+
+    pairs = [s for s in lkup.statements if isinstance(s, ast.PairPosStatement)]
+    singles = [(pos[0], pos[1]) for s in lkup.statements
+               if isinstance(s, ast.SinglePosStatement) and not s.forceChain for pos in s.pos]
+    if pairs and singles:
+        raise ValueError(f'lookup {lkup.name} mixes single and pair positioning')
+
+    # Assign rules last to first so that earlier rules overwrite (i.e., mask) later ones
+    if pairs:
+        res = np.full((len(glyphOrder), len(glyphOrder)), np.nan, dtype=np.float32)
+        for s in reversed(pairs):
+            res[np.ix_(indices(s.glyphs1), indices(s.glyphs2))] = xAdvance(s.valuerecord1)
+    else:
+        res = np.full(len(glyphOrder), np.nan, dtype=np.float32)
+        for glyphs, valueRecord in reversed(singles):
+            res[indices(glyphs)] = xAdvance(valueRecord)
+    return res
+
+# File types writeKernMatrix() can write
+matrixTypes = ('.npy', '.npz', '.csv')
+
+def writeKernMatrix(outfile, kerns, glyphOrder):
+    """ write the result of kernMatrix() to .npy (glyph names go to a .glyphs sidecar), .npz or .csv """
+    import numpy as np
+
+    base, ext = os.path.splitext(outfile)
+    ext = ext.lower()
+    if ext == '.npy':
+        np.save(outfile, kerns)
+        with open(base + '.glyphs', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(glyphOrder) + '\n')
+    elif ext == '.npz':
+        np.savez_compressed(outfile, kerns=kerns, glyphs=np.array(glyphOrder))
+    elif ext == '.csv':
+        def fmt(v):
+            return '' if np.isnan(v) else f'{v:g}'
+        with open(outfile, 'w', newline='', encoding='utf-8') as f:
+            csvwriter = csv.writer(f)
+            if kerns.ndim == 2:
+                csvwriter.writerow([''] + list(glyphOrder))
+                for g, row in zip(glyphOrder, kerns):
+                    csvwriter.writerow([g] + [fmt(v) for v in row])
+            else:
+                for g, v in zip(glyphOrder, kerns):
+                    csvwriter.writerow([g, fmt(v)])
+    else:
+        raise ValueError(f'unsupported matrix file type "{ext}" (use .npy, .npz or .csv)')
 
-    return(res)
 
 if __name__ == '__main__':
 
-    parser=argparse.ArgumentParser()
-    parser.add_argument("infile", help="Path to input fea file", metavar='input-fea-file')
-    parser.add_argument('glyphs', help='comma-separated glyph sequence to trace', metavar='glyphname(s)')
+    parser=argparse.ArgumentParser(epilog='''\
+Parse trees are cached in --cachedir, keyed by the contents of the fea file
+and its includes and the glyph order; the least recently used are removed once
+the cache exceeds 256 MB. --clear-cache empties it.
+
+The --kern data file is indexed for fast lookups. The index is kept in
+--kernindexdir (by default --cachedir) and rebuilt when the data file changes;
+with --nocache and no --kernindexdir, it is rebuilt on every run.
+
+With --batch or --serve, glyph sequences are read one per line (comma-separated;
+blank lines and lines starting with # are ignored) and results are written as
+JSON Lines, one object per sequence. The font and fea file are loaded only once.
+
+With --alloffsets, every offset of the glyph sequence is traced, so contextual
+rules are matched with their full prefix (backtrack), input and suffix context.
+
+With --feature, every lookup of the feature is traced in order at every offset,
+stepping over the glyphs each lookup's lookupflag (IgnoreMarks, mark filtering
+sets, etc.) skips. Glyph classes come from the fea file's GDEF table block, else
+the font's GDEF, else the markClass definitions. Substitutions are reported but
+not applied. The time taken and rules matched are listed for each lookup.
+
+With --compare, the glyph sequence (or each sequence from --batch) is traced
+against the input fea file and every FEAFILE given, each parsed in its own
+process; FONTFILE defaults to --font. What wins at each place something matched
+(every offset with --alloffsets or --feature, every pair with --allpairs) is
+printed side by side as value @ location, with > before the rules of lookups
+called from contextual rules. Rows where the values differ are flagged with *,
+those where only the rule locations differ with ~. For example:
+
+    tracefea.py Regular.fea T,o,V,A -f Regular.ttf --alloffsets -c Bold.fea Bold.ttf -c Arabic.fea
+
+With --gpos, the compiled GPOS table of --font is traced instead of fea source,
+so no fea file is given. Single and pair positioning lookups are traced, subtable
+by subtable; other lookup types are skipped. As in shaping, a class-based
+(format 2) subtable covering the first glyph applies even when the second
+glyph is in class 0, with value 0, masking later subtables. --lookup is a
+lookup index, or a lookup name if the font has the Debg table feaLib adds when
+built with FONTTOOLS_LOOKUP_DEBUGGING=1, which also gives each lookup's fea
+location.
+With --feature, the lookups of all of the feature's records are traced.
+
+With --matrix, the lookup is resolved for every pair (PairPos) or glyph
+(SinglePos) of the glyph sequence, which may be * to use all glyphs in the font
+(or, without --font, all glyphs the lookup mentions). The xAdvance of the
+winning rule is written; unmatched entries are NaN (empty in CSV).
+''', formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("infile", help="Path to input fea file (omit with --gpos)", metavar='input-fea-file', nargs='?')
+    parser.add_argument('glyphs', help='comma-separated glyph sequence to trace (omit with --batch or --serve)', metavar='glyphname(s)', nargs='?')
     parser.add_argument("-f","--font", help="Path to font file")
     parser.add_argument("-l", "--lookup", help="name of lookup to trace", default="mainkern")
+    parser.add_argument("--gpos", help="trace the compiled GPOS table of --font instead of fea source", action='store_true')
+    parser.add_argument("-F", "--feature", help="trace all lookups of this feature (e.g. kern) instead of one lookup")
     parser.add_argument("-k", "--kern", help="raw grkern2fea data file")
+    parser.add_argument("--kernindexdir", metavar='DIR', help="folder for the index of the --kern file (default: --cachedir, or none with --nocache)")
     parser.add_argument("--allpairs", help="test all pairs from glyphs", action='store_true')
+    parser.add_argument("--alloffsets", help="trace the glyph sequence at every offset, not just the first glyph", action='store_true')
+    parser.add_argument("--cachedir", help=f"folder for cached parse trees (default: {defaultCacheDir()})", default=defaultCacheDir())
+    parser.add_argument("--nocache", help="always parse the fea file; don't read or write the cache", action='store_true')
+    parser.add_argument("--clear-cache", help="remove all cached parse trees first; without a fea file, just do that", action='store_true')
+    batchoptions = parser.add_mutually_exclusive_group()
+    batchoptions.add_argument("-b", "--batch", metavar='FILE', help="trace the glyph sequences in FILE ('-' for stdin)")
+    batchoptions.add_argument("--serve", metavar='SOCKET', nargs='?', const='-',
+                              help="stay resident, answering glyph sequences from stdin or, if given, the Unix socket SOCKET")
+    parser.add_argument("-c", "--compare", metavar='FEAFILE [FONTFILE]', nargs='+', action='append',
+                        help="also trace against FEAFILE (with FONTFILE) and show the results side by side; can be repeated")
+    parser.add_argument("-j", "--jobs", type=int, default=0, metavar='N',
+                        help="number of fea files to parse at once with --compare; 0 means one per CPU (default: 0)")
+    batchoptions.add_argument("-m", "--matrix", metavar='OUTFILE', help="write the kern matrix for the glyphs to OUTFILE (.npy, .npz or .csv)")
     ## parser.add_argument("-o", "--outfile", help="Output file of results")
     ## parser.add_argument("-L","--log",default="INFO",help="Logging level [DEBUG, *INFO*, WARN, ERROR]")
     ## parser.add_argument("--logfile",help="Log to file")
-    args = parser.parse_args()
+    instrument.addArguments(parser)
+    # Options may come between the fea file and the glyph sequence, as both positionals are optional
+    args = parser.parse_intermixed_args()
+    if args.clear_cache:
+        print(f'removed {clearCache(args.cachedir)} cached parse tree(s) from {args.cachedir}', file=sys.stderr)
+        if args.infile is None:
+            sys.exit(0)
+    if args.gpos:
+        if args.glyphs is not None:
+            parser.error('no fea file is used with --gpos')
+        args.glyphs, args.infile = args.infile, None
+        if not args.font:
+            parser.error('--gpos needs --font')
+        if args.matrix or args.compare:
+            parser.error('--gpos cannot be used with --matrix or --compare')
+    elif args.infile is None:
+        parser.error('the input fea file is required')
+    if (args.glyphs is None) == (args.batch is None and args.serve is None):
+        parser.error('supply either a glyph sequence or one of --batch or --serve')
+    if args.allpairs and args.alloffsets:
+        parser.error('--allpairs and --alloffsets cannot be used together')
+    if args.feature and (args.allpairs or args.alloffsets or args.matrix):
+        parser.error('--feature cannot be used with --allpairs, --alloffsets or --matrix')
+    if args.compare and (args.matrix or args.serve is not None):
+        parser.error('--compare cannot be used with --matrix or --serve')
+    if args.compare and any(len(c) > 2 for c in args.compare):
+        parser.error('--compare takes a fea file and optionally a font file')
+    if args.matrix and os.path.splitext(args.matrix)[1].lower() not in matrixTypes:
+        parser.error(f'unsupported matrix file type "{args.matrix}" (use {", ".join(matrixTypes)})')
 
-    if args.font:
-        font = TTFont(args.font)
-        parser = Parser(args.infile, font.getReverseGlyphMap())
-    else:
-        parser = Parser(args.infile)
-    parsetree = parser.parse()
-
-    # Find desired lookup
-    lookup = [s for s in parsetree.statements if isinstance(s, ast.LookupBlock) and s.name == args.lookup ]
-    if len(lookup) == 0:
-        print(f'lookup named "{args.lookup}" not found in file "{args.infile}"')
-        sys.exit(1)
-    if len(lookup) > 1:
-        print(f'more than one lookup named "{args.lookup}" found in file "{args.infile}"')
-        sys.exit(1)
-    lookup = lookup[0]
-
-    # Split glyphlist:
-    glyphs = args.glyphs.split(',')
-
-    # If provided, read the raw kern data to find the actual value
-    if args.kern:
-        gnameRE = re.compile(r'\[([^]]+)\]')  # regex to extract glyph names from rawKern data
-        kernRE = re.compile(r'{([^}]+)}')   # regex to extract kern value from rawKern data
-        with open(args.kern, encoding='utf-8') as f:
-            for lineno,line in enumerate(f):
-                dataGlyphs = gnameRE.findall(line)
-                if dataGlyphs == glyphs:
-                    # found the record
-                    kerns = kernRE.findall(line)
-                    if len(kerns) != 1:
-                        print(f'raw data line {lineno}: Unexpected count of kern values ({len(kerns)} in kerndata, data ignored: {line}')
-                    else:
-                        print(f"raw data line {lineno}: Desired kern value = {kerns[0]}")
-                        break
+    # The parse tree lives until exit; spare the collector from scanning it all on the way out
+    atexit.register(gc.freeze)
+
+    inst = instrument.fromArgs(args, 'tracefea')
+    with inst, contextlib.ExitStack() as resources:
+        cachedir = None if args.nocache else args.cachedir
+
+        # Compare several fea files
+        if args.compare:
+            targets = [(args.infile, args.font)] + [(c[0], c[1] if len(c) > 1 else args.font) for c in args.compare]
+            if args.batch is not None:
+                with (sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')) as f:
+                    sequences = [line.strip().split(',') for line in f if line.strip() and not line.strip().startswith('#')]
+            else:
+                sequences = [args.glyphs.split(',')]
+            results = compareFeas(targets, sequences, args.lookup, args.feature, cachedir, args.allpairs, args.alloffsets, args.jobs, inst)
+            labels = [os.path.basename(fea) for fea, font in targets]
+            if len(set(labels)) < len(labels):
+                labels = [f'{os.path.basename(fea)} ({os.path.basename(font) if font else "no font"})' for fea, font in targets]
+            differ = printComparison(labels, sequences, results)
+            print(f'\n{differ} place(s) differ')
+            sys.exit(1 if any(isinstance(r, Exception) for r in results) else 0)
+
+        if args.gpos:
+            with instrument.phase('load font'):
+                font = TTFont(args.font, lazy=True)
+                if 'GPOS' not in font:
+                    print(f'no GPOS table in font "{args.font}"')
+                    sys.exit(1)
+                gpos = GposIndex(font)
+            source = f'the GPOS table of "{args.font}"'
+        else:
+            parsetree, font = loadFea(args.infile, args.font, cachedir)
+            source = f'file "{args.infile}"'
+
+        # Find desired feature or lookup
+        if args.feature:
+            with instrument.phase('compile'):
+                lookup = gpos.feature(args.feature) if args.gpos else FeatureIndex(parsetree, args.feature, font)
+            if len(lookup.lookups) == 0:
+                print(f'no lookups found for feature "{args.feature}" in {source}')
+                sys.exit(1)
+        else:
+            try:
+                lookupBlock = gpos.findLookup(args.lookup) if args.gpos else findLookup(parsetree, args.lookup)
+            except KeyError:
+                print(f'lookup named "{args.lookup}" not found in {source}')
+                sys.exit(1)
+            except ValueError:
+                print(f'more than one lookup named "{args.lookup}" found in {source}')
+                sys.exit(1)
+            with instrument.phase('compile'):
+                lookup = lookupBlock if args.gpos else compileLookup(lookupBlock)
+
+        # Kern matrix
+        if args.matrix:
+            if args.glyphs != '*':
+                glyphOrder = args.glyphs.split(',')
+            elif args.font:
+                glyphOrder = font.getGlyphOrder()
+            else:
+                glyphOrder = sorted(lookup.rules.keys() |
+                                    {g for s in lookupBlock.statements if isinstance(s, ast.PairPosStatement) for g in glyphSet(s.glyphs2)})
+            try:
+                with instrument.phase('matrix'):
+                    kerns = kernMatrix(lookupBlock, glyphOrder)
+            except ValueError as e:
+                print(f'unable to build kern matrix: {e}')
+                sys.exit(1)
+            with instrument.phase('write matrix'):
+                writeKernMatrix(args.matrix, kerns, glyphOrder)
+            sys.exit(0)
+
+        # Index the raw kern data, if provided, to look up the actual values
+        rawkern = None
+        if args.kern:
+            try:
+                with instrument.phase('raw kern'):
+                    rawkern = resources.enter_context(RawKernIndex(args.kern, args.kernindexdir or cachedir))
+            except OSError as e:
+                print(f'unable to read kern data "{args.kern}": {e}', file=sys.stderr)
+                sys.exit(1)
+
+        # Batch and resident modes
+        if args.batch is not None:
+            if args.batch == '-':
+                traceLines(lookup, sys.stdin, sys.stdout, args.allpairs, rawkern, args.alloffsets)
+            else:
+                with open(args.batch, encoding='utf-8') as f:
+                    traceLines(lookup, f, sys.stdout, args.allpairs, rawkern, args.alloffsets)
+            sys.exit(0)
+        if args.serve is not None:
+            if args.serve == '-':
+                try:
+                    traceLines(lookup, sys.stdin, sys.stdout, args.allpairs, rawkern, args.alloffsets)
+                except KeyboardInterrupt:
+                    pass
+            else:
+                try:
+                    serve(lookup, args.serve, args.allpairs, rawkern, args.alloffsets)
+                except OSError as e:
+                    print(f'unable to serve on "{args.serve}": {e}', file=sys.stderr)
+                    sys.exit(1)
+            sys.exit(0)
+
+        # Split glyphlist:
+        glyphs = args.glyphs.split(',')
+
+        # If provided, read the raw kern data to find the actual value
+        if rawkern is not None:
+            with instrument.phase('raw kern'):
+                rawkerns = list(rawkern.find(glyphs))
+            for lineno, line, kerns in rawkerns:
+                if len(kerns) != 1:
+                    print(f'raw data line {lineno}: Unexpected count of kern values ({len(kerns)} in kerndata, data ignored: {line}')
+                else:
+                    print(f"raw data line {lineno}: Desired kern value = {kerns[0]}")
+                    break
             else:
                 print('No matching kern value found in kerndata')
 
-    # Trace fea code
-    if args.allpairs:
-        for g1 in glyphs:
-            for g2 in glyphs:
-                res = traceFea(lookup, (g1, g2))
-                if len(res):
+        # Trace fea code
+        with instrument.phase('trace'):
+            if args.feature:
+                stats = traceFeature(lookup, glyphs)
+                for lkupStats in stats:
+                    if lkupStats['matches'] == 0:
+                        continue
+                    print(f"\ntracing lookup {lkupStats['lookup']} {lkupStats['flags']}--------------------")
+                    for offset, res in lkupStats['trace']:
+                        print(f"offset {offset} ({glyphs[offset]}):")
+                        for x in res:
+                            print(f"    {x}")
+                if args.gpos:
+                    for lkup, flags in lookup.lookups:
+                        if lkup.unsupported:
+                            print(f"\nlookup {lkup.name} not traced: lookup type {', '.join(map(str, sorted(lkup.unsupported)))}")
+                print(f"\nlookup timings (feature {args.feature}):")
+                for lkupStats in sorted(stats, key=lambda s: s['seconds'], reverse=True):
+                    print(f"{lkupStats['seconds'] * 1000:10.3f} ms {lkupStats['matches']:6d} matches  {lkupStats['lookup']}")
+
+            elif args.allpairs:
+                for (g1, g2), res in tracePairs(lookup, glyphs):
                     print(f"\ntracing pair {g1},{g2}--------------------")
                     for x in res:
                         print(x)
 
-    else:
-        for x in traceFea(lookup, glyphs):
-            print(x)
+            elif args.alloffsets:
+                for offset, res in traceRun(lookup, glyphs):
+                    print(f"\ntracing offset {offset} ({glyphs[offset]})--------------------")
+                    for x in res:
+                        print(x)
+
+            else:
+                for x in traceFea(lookup, glyphs):
+                    print(x)